@@ -0,0 +1,78 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class ActivationCache(object):
+    """
+    Memory-mapped fp16 store of frozen bottom-layer outputs. Features with
+    identical windows (input_ids and token_type_ids) share a single slot so
+    that each unique window is computed only once during training.
+
+    Args:
+        path: Path to the memory-mapped ".npy" file. It is overwritten.
+        input_ids: (num_features, seq_len) tensor of the training dataset
+        token_type_ids: (num_features, seq_len) tensor of the training dataset
+        hidden_size: Hidden size of the bottom layers' outputs
+    """
+
+    def __init__(self, path: str, input_ids: torch.Tensor,
+                 token_type_ids: torch.Tensor, hidden_size: int):
+        slots = dict()
+        self.feature_to_slot = np.empty(len(input_ids), dtype=np.int64)
+        input_ids = input_ids.numpy()
+        token_type_ids = token_type_ids.numpy()
+        for i in range(len(input_ids)):
+            key = hashlib.sha1(
+                input_ids[i].tobytes() + token_type_ids[i].tobytes()).digest()
+            self.feature_to_slot[i] = slots.setdefault(key, len(slots))
+        n_slots = len(slots)
+        seq_len = input_ids.shape[1]
+
+        self.path = path
+        self.activations = np.lib.format.open_memmap(
+            path, mode='w+', dtype=np.float16,
+            shape=(n_slots, seq_len, hidden_size))
+        self.filled = np.zeros(n_slots, dtype=bool)
+        logger.info(
+            f'Activation cache at {path}: {len(input_ids)} features, '
+            f'{n_slots} unique windows, '
+            f'{self.activations.nbytes / 1024 ** 3:.2f} GiB')
+
+    def missing(self, feature_indices: np.ndarray) -> np.ndarray:
+        """ Returns a boolean mask of features that are not cached yet """
+        return ~self.filled[self.feature_to_slot[feature_indices]]
+
+    def put(self, feature_indices: np.ndarray, hidden_states: torch.Tensor):
+        slots = self.feature_to_slot[feature_indices]
+        self.activations[slots] = hidden_states.detach().to(
+            'cpu', dtype=torch.float16).numpy()
+        self.filled[slots] = True
+
+    def get(self, feature_indices: np.ndarray) -> torch.Tensor:
+        slots = self.feature_to_slot[feature_indices]
+        return torch.from_numpy(self.activations[slots])
+
+    def close(self):
+        del self.activations
+        if os.path.exists(self.path):
+            os.remove(self.path)
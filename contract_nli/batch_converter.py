@@ -13,27 +13,45 @@
 # limitations under the License.
 
 import torch
+from torch.utils.data.dataloader import default_collate
+
+# Bit weights of numpy.packbits (big-endian bit order)
+_BIT_WEIGHTS = [128, 64, 32, 16, 8, 4, 2, 1]
+
+
+def unpack_mask(mask: torch.Tensor, length: int) -> torch.Tensor:
+    """
+    Unpacks masks packed with contract_nli.dataset.encoder.pack_mask (uint8)
+    to the given length. Unpacked (int8) masks are returned as is.
+    """
+    if mask.dtype != torch.uint8:
+        return mask
+    weights = torch.tensor(_BIT_WEIGHTS, dtype=torch.uint8, device=mask.device)
+    bits = (mask.unsqueeze(-1) & weights) != 0
+    return bits.flatten(start_dim=-2)[..., :length]
 
 
 def identification_classification_converter(batch, model, device, no_labels=False) -> dict:
+    # Datasets store narrow integer types (and compact datasets store p_mask
+    # as bits), which are widened after the (smaller) copy to the device
     batch = tuple(t.to(device) for t in batch)
     inputs = {
-        "input_ids": batch[0],
-        "attention_mask": batch[1],
-        "token_type_ids": batch[2],
-        "p_mask": batch[4],
-        "valid_span_missing_in_context": batch[5]
+        "input_ids": batch[0].long(),
+        "attention_mask": batch[1].long(),
+        "token_type_ids": batch[2].long(),
+        "p_mask": unpack_mask(batch[4], batch[0].shape[1]).float(),
+        "valid_span_missing_in_context": batch[5].float()
     }
     if not no_labels:
-        inputs["class_labels"] = batch[7]
-        inputs["span_labels"] = batch[8]
+        inputs["class_labels"] = batch[7].long()
+        inputs["span_labels"] = batch[8].long()
 
     model_type = model.module.model_type if hasattr(model, "module") else model.model_type
     if model_type in ["xlm", "roberta", "distilbert", "camembert", "bart", "longformer"]:
         del inputs["token_type_ids"]
 
     if model_type in ["xlnet", "xlm"]:
-        inputs.update({"cls_index": batch[3]})
+        inputs.update({"cls_index": batch[3].long()})
     # FIXME: Add lang_id to dataset
     if hasattr(model, "config") and hasattr(model.config, "lang2id"):
         langs = torch.ones(batch[0].shape, dtype=torch.int64) * args.lang_id
@@ -42,24 +60,45 @@ def identification_classification_converter(batch, model, device, no_labels=Fals
 
 
 def classification_converter(batch, model, device, no_labels=False) -> dict:
+    # Datasets store narrow integer types (and compact datasets store p_mask
+    # as bits), which are widened after the (smaller) copy to the device
     batch = tuple(t.to(device) for t in batch)
     inputs = {
-        "input_ids": batch[0],
-        "attention_mask": batch[1],
-        "token_type_ids": batch[2],
-        "p_mask": batch[4],
+        "input_ids": batch[0].long(),
+        "attention_mask": batch[1].long(),
+        "token_type_ids": batch[2].long(),
+        "p_mask": unpack_mask(batch[4], batch[0].shape[1]).float(),
     }
     if not no_labels:
-        inputs["class_labels"] = batch[6]
+        inputs["class_labels"] = batch[6].long()
 
     model_type = model.module.model_type if hasattr(model, "module") else model.model_type
     if model_type in ["xlm", "roberta", "distilbert", "camembert", "bart", "longformer"]:
         del inputs["token_type_ids"]
 
     if model_type in ["xlnet", "xlm"]:
-        inputs.update({"cls_index": batch[3]})
+        inputs.update({"cls_index": batch[3].long()})
     # FIXME: Add lang_id to dataset
     if hasattr(model, "config") and hasattr(model.config, "lang2id"):
         langs = torch.ones(batch[0].shape, dtype=torch.int64) * args.lang_id
         inputs.update({"langs": langs.to(device)})
     return inputs
+
+
+def trim_padding(batch, attention_mask_index: int = 1) -> tuple:
+    """
+    Removes trailing padding columns shared by all windows in a collated
+    batch. Only right padding is trimmed so that positions are preserved.
+    Bit-packed masks have a different width and are sliced when unpacked.
+    """
+    attention_mask = batch[attention_mask_index]
+    seq_len = attention_mask.shape[1]
+    nonzero = (attention_mask != 0).any(dim=0).nonzero()
+    end = int(nonzero[-1]) + 1 if len(nonzero) > 0 else seq_len
+    return tuple(
+        t[:, :end].contiguous() if t.dim() >= 2 and t.shape[1] == seq_len else t
+        for t in batch)
+
+
+def trim_padding_collate(samples) -> tuple:
+    return trim_padding(default_collate(samples))
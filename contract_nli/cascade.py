@@ -0,0 +1,120 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import pickle
+from collections import defaultdict
+from typing import Dict, List
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+
+from contract_nli.dataset.loader import ContractNLIExample, NLILabel
+from contract_nli.postprocess import IdentificationClassificationResult
+
+logger = logging.getLogger(__name__)
+
+
+def is_not_mentioned(example: ContractNLIExample) -> bool:
+    if example.label == NLILabel.NOT_MENTIONED:
+        return True
+    # Span-only datasets (e.g. CUAD) do not have NLI labels. A hypothesis
+    # without any evidence span is "not mentioned" from the cascade's view.
+    return example.label == NLILabel.NONE and not example.annotated_spans
+
+
+class NotMentionedGate(object):
+    """
+    The first stage of the cascaded inference. It estimates the probability
+    of a (document, hypothesis) pair being NotMentioned with a logistic
+    regression over TF-IDF features of the document, trained separately for
+    each hypothesis. Hypotheses that were not seen (or only had a single
+    outcome) during training always get a probability of 0 so that they are
+    never gated.
+    """
+
+    def __init__(self, max_features: int = 50000, C: float = 1.0):
+        self.vectorizer = TfidfVectorizer(
+            max_features=max_features, sublinear_tf=True)
+        self.C = C
+        self.classifiers: Dict[str, LogisticRegression] = dict()
+
+    def _vectorize(self, examples: List[ContractNLIExample], fit: bool):
+        document_ids = sorted({e.document_id for e in examples})
+        document_texts = {e.document_id: e.context_text for e in examples}
+        texts = [document_texts[d] for d in document_ids]
+        if fit:
+            X = self.vectorizer.fit_transform(texts)
+        else:
+            X = self.vectorizer.transform(texts)
+        return X, {d: i for i, d in enumerate(document_ids)}
+
+    def fit(self, examples: List[ContractNLIExample]) -> 'NotMentionedGate':
+        X, doc_rows = self._vectorize(examples, fit=True)
+        rows = defaultdict(list)
+        targets = defaultdict(list)
+        for example in examples:
+            rows[example.hypothesis_id].append(doc_rows[example.document_id])
+            targets[example.hypothesis_id].append(is_not_mentioned(example))
+        self.classifiers = dict()
+        for hypothesis_id in rows.keys():
+            y = np.array(targets[hypothesis_id])
+            if len(np.unique(y)) < 2:
+                logger.info(
+                    f'Hypothesis "{hypothesis_id}" has a single outcome in '
+                    'training data and will not be gated.')
+                continue
+            clf = LogisticRegression(C=self.C, max_iter=1000)
+            clf.fit(X[rows[hypothesis_id]], y)
+            self.classifiers[hypothesis_id] = clf
+        logger.info(
+            f'Trained NotMentioned gate for {len(self.classifiers)}/{len(rows)} hypotheses')
+        return self
+
+    def predict_proba(self, examples: List[ContractNLIExample]) -> np.ndarray:
+        """ Returns the probability of each example being NotMentioned """
+        X, doc_rows = self._vectorize(examples, fit=False)
+        probs = np.zeros(len(examples))
+        by_hypothesis = defaultdict(list)
+        for i, example in enumerate(examples):
+            if example.hypothesis_id in self.classifiers:
+                by_hypothesis[example.hypothesis_id].append(i)
+        for hypothesis_id, indices in by_hypothesis.items():
+            clf = self.classifiers[hypothesis_id]
+            pos = list(clf.classes_).index(True)
+            doc_indices = [doc_rows[examples[i].document_id] for i in indices]
+            probs[indices] = clf.predict_proba(X[doc_indices])[:, pos]
+        return probs
+
+    @staticmethod
+    def to_result(example: ContractNLIExample, prob: float) -> IdentificationClassificationResult:
+        class_probs = np.full(3, (1.0 - prob) / 2.0)
+        class_probs[NLILabel.NOT_MENTIONED.value] = prob
+        span_probs = np.zeros((len(example.splits), 2))
+        span_probs[:, 0] = 1.0
+        return IdentificationClassificationResult(
+            data_id=example.data_id,
+            class_probs=class_probs,
+            span_probs=span_probs
+        )
+
+    def save(self, path: str):
+        with open(path, 'wb') as fout:
+            pickle.dump(self, fout)
+
+    @staticmethod
+    def load(path: str) -> 'NotMentionedGate':
+        with open(path, 'rb') as fin:
+            return pickle.load(fin)
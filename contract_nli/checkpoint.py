@@ -0,0 +1,126 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import json
+import logging
+import os
+import shutil
+import threading
+from typing import Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def to_cpu(obj):
+    """ Recursively copies tensors in a (nested) state dict to CPU memory """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def checkpoint_step(checkpoint_dir: str) -> int:
+    return int(checkpoint_dir.split("-")[-1])
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints in a background thread. The caller snapshots states to
+    CPU memory and write() returns immediately. At most one write is in
+    flight; a new write waits for the previous one. Callers should also call
+    wait() before taking a snapshot, so that only one snapshot is held in
+    memory.
+
+    A checkpoint is written to a temporary directory and renamed in place, so
+    that a crash never leaves a partially written checkpoint behind.
+
+    Args:
+        output_dir: Directory that contains "checkpoint-*" directories
+        save_total_limit: If set, only the latest save_total_limit
+            "checkpoint-*" directories are kept. Other directories (e.g.
+            "best-checkpoint") are never deleted.
+    """
+
+    def __init__(self, output_dir: str, save_total_limit: Optional[int] = None):
+        if save_total_limit is not None and save_total_limit < 1:
+            raise ValueError('save_total_limit must be a positive integer')
+        self.output_dir = output_dir
+        self.save_total_limit = save_total_limit
+        self.thread: Optional[threading.Thread] = None
+        self.error: Optional[BaseException] = None
+
+    def write(self, checkpoint_dir: str, model, state_dict: dict,
+              states: dict, trainer_info: dict):
+        """
+        Args:
+            model: Model whose save_pretrained writes the config and state_dict
+            state_dict: Model parameters in CPU memory
+            states: File names to other states in CPU memory (e.g. optimizer)
+        """
+        self.wait()
+        self.thread = threading.Thread(
+            target=self._write,
+            args=(checkpoint_dir, model, state_dict, states, trainer_info),
+            daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        """ Blocks until the pending write finishes and raises its error """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Failed to write a checkpoint') from error
+
+    def _write(self, checkpoint_dir, model, state_dict, states, trainer_info):
+        try:
+            tmp_dir = checkpoint_dir + '.tmp'
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            model.save_pretrained(tmp_dir, state_dict=state_dict)
+            for filename, state in states.items():
+                torch.save(state, os.path.join(tmp_dir, filename))
+            with open(os.path.join(tmp_dir, 'trainer_info.json'), 'w') as fout:
+                json.dump(trainer_info, fout, indent=2)
+
+            if os.path.exists(checkpoint_dir):
+                # Directories cannot be atomically replaced with os.replace
+                old_dir = checkpoint_dir + '.old'
+                os.replace(checkpoint_dir, old_dir)
+                os.replace(tmp_dir, checkpoint_dir)
+                shutil.rmtree(old_dir)
+            else:
+                os.replace(tmp_dir, checkpoint_dir)
+            logger.info(f"Finished saving checkpoint to {checkpoint_dir}")
+            self._rotate()
+        except BaseException as e:
+            self.error = e
+
+    def _rotate(self):
+        if self.save_total_limit is None:
+            return
+        checkpoint_dirs = sorted(
+            [d for d in glob.glob(os.path.join(self.output_dir, 'checkpoint-*'))
+             if d.split('-')[-1].isdigit()],
+            key=checkpoint_step)
+        for checkpoint_dir in checkpoint_dirs[:-self.save_total_limit]:
+            logger.info(f"Deleting old checkpoint {checkpoint_dir}")
+            shutil.rmtree(checkpoint_dir)
@@ -0,0 +1,183 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+from typing import Iterable, List, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Bump this when changes to the encoders invalidate cached features
+FEATURE_CACHE_VERSION = 3
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Hash of everything that changes subword tokenization: the tokenizer
+    class, its vocabulary, special tokens (e.g. SPAN_TOKEN and hypothesis
+    symbols, which are never split) and lower casing.
+    """
+    state = {
+        'class': type(tokenizer).__name__,
+        'vocab': sorted(tokenizer.get_vocab().items()),
+        'special_tokens': tokenizer.all_special_tokens,
+        'do_lower_case': getattr(tokenizer, 'do_lower_case', None),
+    }
+    return hashlib.sha1(json.dumps(state).encode('utf-8')).hexdigest()
+
+
+def document_fingerprint(tokens: List[str], splits: List[int]) -> str:
+    return hashlib.sha1(json.dumps([tokens, splits]).encode('utf-8')).hexdigest()
+
+
+def document_fingerprints(examples) -> List[str]:
+    """
+    document_fingerprint of each example, computed once per document as
+    examples of different hypotheses share the document
+    """
+    fingerprints = dict()
+    for example in examples:
+        if example.document_id not in fingerprints:
+            fingerprints[example.document_id] = document_fingerprint(
+                example.tokens, example.splits)
+    return [fingerprints[e.document_id] for e in examples]
+
+
+def file_fingerprint(path: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _atomic_save(obj, path: str):
+    # Other processes may read the same file
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class TokenizationCache(object):
+    """
+    Persistent cache of subword tokenized documents with one file per
+    document_fingerprint. There is one cache directory per
+    tokenizer_fingerprint, so it is shared between feature caches with
+    different max_seq_length, max_query_length or doc_stride, which only need
+    to redo windowing, and between processes that tokenize different
+    documents (e.g. shards). Entries are written atomically as soon as they
+    are added.
+    The classification encoder stores tokenized annotated spans of documents
+    in the same directory under "spans_" prefixed keys.
+
+    Args:
+        overwrite: Ignore the entries that were not written by this instance
+    """
+
+    def __init__(self, cache_dir: str, tokenizer, overwrite: bool = False):
+        self.cache_dir = os.path.join(
+            cache_dir, f'cached_tokenization_{tokenizer_fingerprint(tokenizer)[:16]}')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.overwrite = overwrite
+        self.written = set()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.pt')
+
+    def get(self, key: str, default=None):
+        if self.overwrite and key not in self.written:
+            return default
+        try:
+            return torch.load(self._path(key))
+        except FileNotFoundError:
+            return default
+
+    def __setitem__(self, key: str, document):
+        _atomic_save(document, self._path(key))
+        self.written.add(key)
+
+
+class FeatureCache(object):
+    """
+    Content-addressed store with one file per key, used for the features of
+    each document so that only new or changed documents are converted.
+
+    Reading an entry updates its modification time, and evict() deletes the
+    least recently used entries until the store fits in max_bytes.
+
+    Args:
+        max_bytes: Disk budget of the store. Unlimited if None.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: Optional[int] = None):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.pt')
+
+    def get(self, key: str):
+        """ Returns the entry or None if it is not cached """
+        path = self._path(key)
+        try:
+            entry = torch.load(path)
+            os.utime(path)
+        except FileNotFoundError:
+            # Possibly evicted by another process
+            return None
+        return entry
+
+    def put(self, key: str, entry):
+        _atomic_save(entry, self._path(key))
+
+    def evict(self, keep: Iterable[str] = ()):
+        """ Deletes least recently used entries except keep """
+        if self.max_bytes is None:
+            return
+        keep = {self._path(key) for key in keep}
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pt'):
+                # e.g. files being written by _atomic_save in other processes
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        n_evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            n_evicted += 1
+        if n_evicted > 0:
+            logger.info(f'Evicted {n_evicted} entries from {self.cache_dir}')
+        if total > self.max_bytes:
+            logger.warning(
+                f'Feature cache {self.cache_dir} ({total / 2 ** 20:.1f}MB) exceeds '
+                f'its budget ({self.max_bytes / 2 ** 20:.1f}MB) with the features in use')
@@ -17,19 +17,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import hashlib
 import json
 import logging
 import os
-from typing import Tuple, List, Optional, Union
+from typing import Dict, Iterable, Tuple, List, Optional, Union
 
+import numpy as np
 import torch
 from torch.utils.data import TensorDataset
 
+from contract_nli.dataset.cache import FEATURE_CACHE_VERSION, FeatureCache, \
+    TokenizationCache, document_fingerprint, file_fingerprint, tokenizer_fingerprint
 from contract_nli.dataset.encoder import convert_examples_to_features, \
     IdentificationClassificationFeatures
 from contract_nli.dataset.encoder_classification import convert_examples_to_features as convert_examples_to_classification_features
 from contract_nli.dataset.encoder_classification import ClassificationFeatures
 from contract_nli.dataset.loader import ContractNLIExample
+from contract_nli.dataset.reader import stream_dataset
 
 logger = logging.getLogger(__name__)
 
@@ -42,7 +48,8 @@ def load_and_cache_examples(
     except OSError:
         pass
     filename = os.path.splitext(os.path.basename(path))[0]
-    cachename = f'cached_examples_{filename}'
+    # Keyed by the content so that an edited file is never read from a stale cache
+    cachename = f'cached_examples_{filename}_{file_fingerprint(path)[:16]}'
     cached_examples_file = os.path.join(cache_dir, cachename)
 
     # Init features and dataset from cache if it exists
@@ -53,10 +60,7 @@ def load_and_cache_examples(
     else:
         assert local_rank in [-1, 0]
         logger.info(f"Creating examples from dataset file at {path}")
-        with open(path) as fin:
-            input_dict = json.load(fin)
-        examples = ContractNLIExample.load(input_dict)
-
+        examples = list(ContractNLIExample.iter_load(stream_dataset(path)))
 
         logger.info("Saving examples into cached file %s", cached_examples_file)
         torch.save({"examples": examples}, cached_examples_file)
@@ -64,59 +68,398 @@ def load_and_cache_examples(
     return examples
 
 
+def _features_cachename(
+        path: str, tokenizer, *, max_seq_length: int, doc_stride: int,
+        max_query_length: int, dataset_type: str, labels_available: bool,
+        segmentation: str, segmentation_min_context: int,
+        compact_features: bool = False) -> str:
+    filename = os.path.splitext(os.path.basename(path))[0]
+    tokenizer_name = os.path.splitext(os.path.split(tokenizer.name_or_path)[-1])[0]
+    cachename = f'cached_features_{filename}_{dataset_type}_{tokenizer_name}_{max_seq_length}_{max_query_length}_{doc_stride}'
+    if dataset_type == 'identification_classification' and segmentation != 'greedy':
+        cachename += f'_{segmentation}{segmentation_min_context}'
+    if not labels_available:
+        cachename += '_nolabels'
+    if compact_features:
+        cachename += '_compact'
+    return cachename
+
+
+def _convert_examples(
+        examples: List[ContractNLIExample], tokenizer, *, max_seq_length: int,
+        doc_stride: int, max_query_length: int, dataset_type: str,
+        symbol_based_hypothesis: bool, threads: Optional[int],
+        labels_available: bool, segmentation: str, segmentation_min_context: int,
+        compact_features: bool, tokenization_cache: TokenizationCache):
+    if dataset_type == 'identification_classification':
+        return convert_examples_to_features(
+            examples=examples,
+            tokenizer=tokenizer,
+            max_seq_length=max_seq_length,
+            doc_stride=doc_stride,
+            max_query_length=max_query_length,
+            labels_available=labels_available,
+            symbol_based_hypothesis=symbol_based_hypothesis,
+            threads=threads,
+            segmentation=segmentation,
+            min_context=segmentation_min_context,
+            tokenization_cache=tokenization_cache,
+            compact=compact_features
+        )
+    elif dataset_type == 'classification':
+        return convert_examples_to_classification_features(
+            examples=examples,
+            tokenizer=tokenizer,
+            max_seq_length=max_seq_length,
+            max_query_length=max_query_length,
+            symbol_based_hypothesis=symbol_based_hypothesis,
+            threads=threads,
+            tokenization_cache=tokenization_cache,
+            compact=compact_features
+        )
+    else:
+        assert not "dataset_type must be either 'classification' or 'identification_classification'"
+
+
+def _document_key(
+        examples: List[ContractNLIExample], tokenizer_hash: str, params: dict) -> str:
+    """
+    Content hash of everything that features of a document depend on. params
+    are the feature parameters, e.g. max_seq_length and doc_stride.
+    """
+    state = [
+        FEATURE_CACHE_VERSION,
+        tokenizer_hash,
+        params,
+        document_fingerprint(examples[0].tokens, examples[0].splits),
+        [(e.data_id, e.hypothesis_symbol, e.hypothesis_tokens, e.label.value,
+          e.annotated_spans) for e in examples]
+    ]
+    return hashlib.sha1(json.dumps(state).encode('utf-8')).hexdigest()
+
+
+def _feature_params(
+        *, max_seq_length: int, doc_stride: int, max_query_length: int,
+        dataset_type: str, symbol_based_hypothesis: bool,
+        labels_available: bool = True, segmentation: str = 'greedy',
+        segmentation_min_context: int = 0, compact_features: bool = False,
+        **_) -> dict:
+    """ Feature parameters that are part of the cache keys of documents """
+    return dict(
+        max_seq_length=max_seq_length, doc_stride=doc_stride,
+        max_query_length=max_query_length, dataset_type=dataset_type,
+        symbol_based_hypothesis=symbol_based_hypothesis,
+        labels_available=labels_available, segmentation=segmentation,
+        segmentation_min_context=segmentation_min_context,
+        compact_features=compact_features)
+
+
+def _document_keys(
+        examples: List[ContractNLIExample], tokenizer, params: dict) -> Dict[str, str]:
+    """ Cache key of each document in the order of examples """
+    tokenizer_hash = tokenizer_fingerprint(tokenizer)
+    documents = collections.OrderedDict()
+    for example in examples:
+        documents.setdefault(example.document_id, []).append(example)
+    return collections.OrderedDict(
+        (document_id, _document_key(document_examples, tokenizer_hash, params))
+        for document_id, document_examples in documents.items())
+
+
+def _feature_cache(cache_dir: str, cache_max_mb: Optional[float]) -> FeatureCache:
+    return FeatureCache(
+        os.path.join(cache_dir, 'cached_features'),
+        max_bytes=None if cache_max_mb is None else int(cache_max_mb * 2 ** 20))
+
+
+def feature_cache_keys(examples: List[ContractNLIExample], tokenizer, **kwargs) -> List[str]:
+    """
+    Cache keys of the documents of examples, where kwargs are the keyword
+    arguments given to load_and_cache_features
+    """
+    return list(_document_keys(examples, tokenizer, _feature_params(**kwargs)).values())
+
+
+def evict_feature_cache(
+        keep: Iterable[str], *, cache_dir: str = '.',
+        cache_max_mb: Optional[float] = None):
+    """
+    Evicts least recently used documents from the feature cache under
+    cache_dir except keep (see feature_cache_keys)
+    """
+    _feature_cache(cache_dir, cache_max_mb).evict(keep=keep)
+
+
+def _load_or_convert_documents(
+        examples: List[ContractNLIExample], tokenizer, *, feature_cache: FeatureCache,
+        tokenization_cache: TokenizationCache, max_seq_length: int,
+        doc_stride: int, max_query_length: int, dataset_type: str,
+        symbol_based_hypothesis: bool, threads: Optional[int],
+        labels_available: bool, segmentation: str, segmentation_min_context: int,
+        compact_features: bool = False, overwrite_cache: bool = False,
+        local_rank: int = -1):
+    """
+    Returns the cache keys and (dataset, features) of each document in the
+    order of examples, and (dataset, features) of all documents as converted
+    at once if none of them was in feature_cache (None otherwise). Documents
+    in feature_cache are loaded and the others are converted and added to it.
+    The caller evicts the cache, as other processes may be using the same
+    cache.
+    """
+    params = _feature_params(
+        max_seq_length=max_seq_length, doc_stride=doc_stride,
+        max_query_length=max_query_length, dataset_type=dataset_type,
+        symbol_based_hypothesis=symbol_based_hypothesis,
+        labels_available=labels_available, segmentation=segmentation,
+        segmentation_min_context=segmentation_min_context,
+        compact_features=compact_features)
+    documents = collections.OrderedDict()
+    for example in examples:
+        documents.setdefault(example.document_id, []).append(example)
+    keys = _document_keys(examples, tokenizer, params)
+
+    entries = dict()
+    if not overwrite_cache:
+        for document_id, key in keys.items():
+            entry = feature_cache.get(key)
+            if entry is not None:
+                entries[document_id] = entry
+    missing = [d for d in documents.keys() if d not in entries]
+    if len(entries) > 0:
+        logger.info(f'Loaded features of {len(entries)} documents from {feature_cache.cache_dir}')
+    converted = None
+    if len(missing) > 0:
+        assert local_rank in [-1, 0]
+        logger.info(f'Creating features of {len(missing)} documents')
+        features, dataset = _convert_examples(
+            [e for d in missing for e in documents[d]], tokenizer,
+            tokenization_cache=tokenization_cache, threads=threads, **params)
+        document_ids = {e.data_id: e.document_id for e in examples}
+        n_features = collections.Counter(document_ids[f.data_id] for f in features)
+        # Features of a document are consecutive as examples were grouped by
+        # document, so entries are views of the converted dataset
+        start = 0
+        for document_id in missing:
+            end = start + n_features[document_id]
+            entry = (
+                TensorDataset(*[t[start:end] for t in dataset.tensors]),
+                features[start:end]
+            )
+            # Views would be saved with the whole storage
+            feature_cache.put(
+                keys[document_id],
+                (TensorDataset(*[t.clone() for t in entry[0].tensors]), entry[1]))
+            entries[document_id] = entry
+            start = end
+        if len(missing) == len(documents):
+            converted = (dataset, features)
+    return [keys[d] for d in documents.keys()], [entries[d] for d in documents.keys()], converted
+
+
 def load_and_cache_features(
         path: str, examples: List[ContractNLIExample], tokenizer, *,
         max_seq_length: int, doc_stride: int, max_query_length: int,
         dataset_type: str, symbol_based_hypothesis: bool,
         threads: Optional[int] = 1, local_rank: int = 1,
-        overwrite_cache = False, labels_available=True, cache_dir: str = '.'
+        overwrite_cache = False, labels_available=True, cache_dir: str = '.',
+        segmentation: str = 'greedy', segmentation_min_context: int = 0,
+        cache_max_mb: Optional[float] = None, compact_features: bool = False,
+        evict: bool = True
         ) -> Tuple[TensorDataset, List[Union[IdentificationClassificationFeatures, ClassificationFeatures]]]:
+    """
+    Features are cached per document in "cached_features" under cache_dir,
+    keyed by the content of the document, its hypotheses and labels, the
+    tokenizer (including added special tokens) and the feature parameters.
+    Only new or changed documents are converted, and the least recently used
+    documents are evicted when the cache grows beyond cache_max_mb.
+
+    Callers that load several datasets into the same cache, possibly from
+    several processes, pass evict=False and call evict_feature_cache once
+    all of them have been loaded.
+
+    With compact_features, p_mask is stored bit-packed and unpacked by the
+    batch converters on the device.
+    """
     try:
         os.makedirs(cache_dir)
     except OSError:
         pass
-    filename = os.path.splitext(os.path.basename(path))[0]
-    tokenizer_name = os.path.splitext(os.path.split(tokenizer.name_or_path)[-1])[0]
-    cachename = f'cached_features_{filename}_{dataset_type}_{tokenizer_name}_{max_seq_length}_{max_query_length}_{doc_stride}'
-    if not labels_available:
-        cachename += '_nolabels'
-    cached_features_file = os.path.join(cache_dir, cachename)
+    feature_cache = _feature_cache(cache_dir, cache_max_mb)
+    # Features with different windowing share tokenized documents
+    tokenization_cache = TokenizationCache(
+        cache_dir, tokenizer, overwrite=overwrite_cache)
+    keys, documents, converted = _load_or_convert_documents(
+        examples, tokenizer, feature_cache=feature_cache,
+        tokenization_cache=tokenization_cache, max_seq_length=max_seq_length,
+        doc_stride=doc_stride, max_query_length=max_query_length,
+        dataset_type=dataset_type, symbol_based_hypothesis=symbol_based_hypothesis,
+        threads=threads, labels_available=labels_available,
+        segmentation=segmentation, segmentation_min_context=segmentation_min_context,
+        compact_features=compact_features, overwrite_cache=overwrite_cache,
+        local_rank=local_rank)
+    if evict and local_rank in [-1, 0]:
+        # Only the process that creates features evicts the shared cache
+        feature_cache.evict(keep=keys)
+    dataset, features, _ = _merge_shards(documents, examples, dataset_type, converted)
+    return dataset, features
 
-    # Init features and dataset from cache if it exists
-    if os.path.exists(cached_features_file) and not overwrite_cache:
-        logger.info("Loading features from cached file %s", cached_features_file)
-        features_and_dataset = torch.load(cached_features_file)
-        features, dataset = (
-            features_and_dataset["features"],
-            features_and_dataset["dataset"]
-        )
-    else:
-        assert local_rank in [-1, 0]
-        logger.info(f"Creating features from dataset file at {path}")
-        if dataset_type == 'identification_classification':
-            features, dataset = convert_examples_to_features(
-                examples=examples,
-                tokenizer=tokenizer,
-                max_seq_length=max_seq_length,
-                doc_stride=doc_stride,
-                max_query_length=max_query_length,
-                labels_available=labels_available,
-                symbol_based_hypothesis=symbol_based_hypothesis,
-                threads=threads
-            )
-        elif dataset_type == 'classification':
-            features, dataset = convert_examples_to_classification_features(
-                examples=examples,
-                tokenizer=tokenizer,
-                max_seq_length=max_seq_length,
-                max_query_length=max_query_length,
-                symbol_based_hypothesis=symbol_based_hypothesis,
-                threads=threads
-            )
-        else:
-            assert not "dataset_type must be either 'classification' or 'identification_classification'"
 
-        logger.info("Saving features into cached file %s", cached_features_file)
-        torch.save({"features": features, "dataset": dataset}, cached_features_file)
+def assign_documents(examples: List[ContractNLIExample], num_shards: int) -> Dict[str, int]:
+    """
+    Assigns each document to a shard so that the total context length (summed
+    over the hypotheses) is balanced between shards. Documents are assigned
+    longest first to the shard with the smallest load, which is deterministic
+    so that every process computes the same assignment.
+    """
+    sizes = collections.Counter()
+    for example in examples:
+        sizes[example.document_id] += len(example.context_text)
+    if len(sizes) < num_shards:
+        raise ValueError(
+            f'Cannot split {len(sizes)} documents into {num_shards} shards')
+    loads = np.zeros(num_shards, dtype=np.int64)
+    assignment = dict()
+    for document_id, size in sorted(sizes.items(), key=lambda x: (-x[1], x[0])):
+        shard = int(np.argmin(loads))
+        assignment[document_id] = shard
+        loads[shard] += size
+    return assignment
+
+
+def _merge_shards(shards, examples: List[ContractNLIExample], dataset_type: str,
+                  converted=None):
+    """
+    Concatenates (dataset, features) shards (e.g. of each document) in the
+    order of examples and renumbers example_index, unique_id and feature
+    indices so that the result is identical to features of examples
+    converted at once. Datasets are released from shards once they are
+    copied, so shards only keep the features.
+
+    Args:
+        converted: (dataset, features) of all shards converted at once in
+            the order of shards, which is returned without copies if that is
+            also the order of examples
+    """
+    example_positions = {e.data_id: i for i, e in enumerate(examples)}
+    # Features of an example are consecutive and belong to a single shard
+    order = sorted(
+        (example_positions[feature.data_id], shard, position)
+        for shard, (_, features) in enumerate(shards)
+        for position, feature in enumerate(features))
+    order = [(shard, position) for _, shard, position in order]
+    if converted is not None and order == sorted(order):
+        return converted[0], converted[1], order
+
+    # Output row of each feature of each shard
+    rows = [np.empty(len(features), dtype=np.int64) for _, features in shards]
+    for row, (shard, position) in enumerate(order):
+        rows[shard][position] = row
+    # Empty shards are skipped as their tensors may not have the right shape
+    template = next(dataset for dataset, features in shards if len(features) > 0)
+    tensors = [
+        torch.empty((len(order),) + t.shape[1:], dtype=t.dtype) for t in template.tensors]
+    del template
+    for shard, (dataset, features) in enumerate(shards):
+        if len(features) > 0:
+            index = torch.from_numpy(rows[shard])
+            for output, tensor in zip(tensors, dataset.tensors):
+                output[index] = tensor
+        shards[shard] = (None, features)
+    feature_index_column = 6 if dataset_type == 'identification_classification' else 5
+    tensors[feature_index_column] = torch.arange(len(order), dtype=torch.long)
+
+    features = []
+    example_index = -1
+    for shard, position in order:
+        feature = shards[shard][1][position]
+        if len(features) == 0 or features[-1].data_id != feature.data_id:
+            example_index += 1
+        feature.example_index = example_index
+        feature.unique_id = 1000000000 + len(features)
+        features.append(feature)
+    return TensorDataset(*tensors), features, order
+
+
+def load_and_cache_features_sharded(
+        path: str, examples: List[ContractNLIExample], tokenizer, *,
+        rank: int, world_size: int, merge: bool = False,
+        max_seq_length: int, doc_stride: int, max_query_length: int,
+        dataset_type: str, symbol_based_hypothesis: bool,
+        threads: Optional[int] = 1, overwrite_cache = False,
+        labels_available=True, cache_dir: str = '.',
+        segmentation: str = 'greedy', segmentation_min_context: int = 0,
+        cache_max_mb: Optional[float] = None, compact_features: bool = False,
+        evict: bool = True
+        ) -> Tuple[TensorDataset, List[Union[IdentificationClassificationFeatures, ClassificationFeatures]]]:
+    """
+    Builds features in parallel on all distributed processes. Documents are
+    split into world_size shards (see assign_documents) and each process
+    converts and caches only the documents of its own shard, so preprocessing
+    time scales down with the number of processes. Must be called by every
+    process.
+
+    When merge is False, each process returns its own shard only, which
+    suits training with a per-process sampler. When merge is True, every
+    process returns all features in the same order as load_and_cache_features,
+    which requires the cache_dir to be shared between processes. Rank 0 also
+    writes an index that maps the merged features to the cached documents.
+    See load_and_cache_features for evict.
+    """
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        pass
+    feature_cache = _feature_cache(cache_dir, cache_max_mb)
+    # Shards add their documents to the same cache, which is keyed by the
+    # documents and the tokenizer only
+    tokenization_cache = TokenizationCache(
+        cache_dir, tokenizer, overwrite=overwrite_cache)
+    kwargs = dict(
+        feature_cache=feature_cache, tokenization_cache=tokenization_cache,
+        max_seq_length=max_seq_length, doc_stride=doc_stride,
+        max_query_length=max_query_length, dataset_type=dataset_type,
+        symbol_based_hypothesis=symbol_based_hypothesis, threads=threads,
+        labels_available=labels_available, segmentation=segmentation,
+        segmentation_min_context=segmentation_min_context,
+        compact_features=compact_features)
+
+    assignment = assign_documents(examples, world_size)
+    shard_examples = [e for e in examples if assignment[e.document_id] == rank]
+    logger.info(
+        f"Loading features of shard {rank}/{world_size} "
+        f"({len(shard_examples)} of {len(examples)} examples) from dataset file at {path}")
+    _, documents, converted = _load_or_convert_documents(
+        shard_examples, tokenizer, overwrite_cache=overwrite_cache, **kwargs)
+
+    if world_size > 1:
+        torch.distributed.barrier()
+    if evict and rank == 0:
+        # Evicts once every process has written its shard, keeping the
+        # documents of all shards
+        feature_cache.evict(
+            keep=_document_keys(examples, tokenizer, _feature_params(**kwargs)).values())
+    if not merge:
+        dataset, features, _ = _merge_shards(
+            documents, shard_examples, dataset_type, converted)
+        return dataset, features
+    del documents, converted
 
+    # Documents of the other shards have been cached by the other processes
+    keys, documents, _ = _load_or_convert_documents(examples, tokenizer, **kwargs)
+    dataset, features, order = _merge_shards(documents, examples, dataset_type)
+    if rank == 0:
+        cachename = _features_cachename(
+            path, tokenizer, max_seq_length=max_seq_length, doc_stride=doc_stride,
+            max_query_length=max_query_length, dataset_type=dataset_type,
+            labels_available=labels_available, segmentation=segmentation,
+            segmentation_min_context=segmentation_min_context,
+            compact_features=compact_features)
+        index_file = os.path.join(cache_dir, f'{cachename}_shards{world_size}_index.json')
+        logger.info("Saving merged feature index into %s", index_file)
+        with open(index_file, 'w') as fout:
+            json.dump({
+                'documents': keys,
+                'num_features': [len(f) for _, f in documents],
+                'order': order
+            }, fout)
     return dataset, features
@@ -15,34 +15,61 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 from functools import partial
-from multiprocessing import Pool, cpu_count
-from typing import List, Dict
-from collections import defaultdict
+from multiprocessing import Pool
+from typing import List, Dict, Tuple
+from collections import defaultdict, OrderedDict
 
 import numpy as np
 import torch
 from torch.utils.data import TensorDataset
 from tqdm import tqdm
-from transformers.tokenization_utils_base import BatchEncoding, \
-    PreTrainedTokenizerBase
+from transformers.tokenization_utils_base import PreTrainedTokenizerBase
 from transformers.utils import logging
 
+from contract_nli.dataset.cache import document_fingerprints
 from contract_nli.dataset.loader import ContractNLIExample, NLILabel
+from contract_nli.utils import available_cpus
 
 # Store the tokenizers which insert 2 separators tokens
 MULTI_SEP_TOKENS_TOKENIZERS_SET = {"roberta", "camembert", "bart", "mpnet"}
 SPAN_TOKEN = '[SPAN]'
+SEGMENTATIONS = {'greedy', 'optimal'}
+# Per-window arrays that are stored in the dataset rather than in features
+# built by convert_examples_to_features
+ARRAY_FIELDS = ['input_ids', 'attention_mask', 'token_type_ids', 'p_mask', 'span_labels']
 
 
 logger = logging.get_logger(__name__)
 
 
+def pack_mask(mask) -> np.ndarray:
+    """
+    Packs a 0/1 mask into bits (8 positions per uint8). Compact datasets
+    store p_mask this way and batch_converter.unpack_mask restores it.
+    """
+    return np.packbits(np.asarray(mask, dtype=np.uint8), axis=-1)
+
+
+def p_mask_shape(n_rows: int, max_seq_length: int, compact: bool):
+    if compact:
+        return (n_rows, (max_seq_length + 7) // 8), np.uint8
+    return (n_rows, max_seq_length), np.int8
+
+
 class IdentificationClassificationFeatures:
     """
     Single example features to be fed to a model. Those features are model-specific and can be crafted from
     :class:`~contract_nli.dataset.loader.ContractNLIExample` using the
     :method:`~contract_nli.dataset.encoder.convert_examples_to_features` method.
+    Features returned by convert_examples_to_features do not hold the
+    per-window arrays (ARRAY_FIELDS are None), which are only stored in the
+    dataset.
+
+    Fields that are only needed for debugging (token_is_max_context,
+    get_tokens and get_token_to_orig_map) are computed on demand from the
+    window plan.
 
     Args:
         input_ids: Indices of input sequence tokens in the vocabulary.
@@ -54,19 +81,25 @@ class IdentificationClassificationFeatures:
         example_index: the index of the example
         unique_id: The unique Feature identifier
         paragraph_len: The length of the context
-        token_is_max_context: List of booleans identifying which tokens have their maximum context in this feature object.
-            If a token does not have their maximum context in this feature object, it means that another feature object
-            has more information related to that token and should be prioritized over this feature for that token.
-        tokens: list of tokens corresponding to the input ids
-        token_to_orig_map: mapping between the tokens and the original text.
         span_to_orig_map: mapping between the spans and the original spans, needed in order to identify the answer.
         class_label:
         span_labels:
         valid_span_missing_in_context: Class label is NOT "not mentioned" and a valid span is not in the context
         data_id:
-        encoding: optionally store the BatchEncoding with the fast-tokenizer alignement methods.
+        window_start: Position of the first context token in the document tokens
+        context_offset: Position of the first context token in input_ids
+        windows: (window_start, paragraph_len) of every window of the example,
+            which is shared between the features of the example
+        window_index: Index of this feature's window in windows
     """
 
+    __slots__ = [
+        'input_ids', 'attention_mask', 'token_type_ids', 'cls_index', 'p_mask',
+        'example_index', 'unique_id', 'paragraph_len', 'span_to_orig_map',
+        'class_label', 'span_labels', 'valid_span_missing_in_context', 'data_id',
+        'window_start', 'context_offset', 'windows', 'window_index'
+    ]
+
     def __init__(
         self,
         input_ids,
@@ -77,15 +110,15 @@ class IdentificationClassificationFeatures:
         example_index,
         unique_id,
         paragraph_len,
-        token_is_max_context,
-        tokens,
-        token_to_orig_map,
         span_to_orig_map,
         class_label,
         span_labels,
         valid_span_missing_in_context,
         data_id: str = None,
-        encoding: BatchEncoding = None,
+        window_start: int = 0,
+        context_offset: int = 0,
+        windows: Tuple[Tuple[int, int], ...] = (),
+        window_index: int = 0,
     ):
         self.input_ids = input_ids
         self.attention_mask = attention_mask
@@ -96,9 +129,6 @@ class IdentificationClassificationFeatures:
         self.example_index = example_index
         self.unique_id = unique_id
         self.paragraph_len = paragraph_len
-        self.token_is_max_context = token_is_max_context
-        self.tokens = tokens
-        self.token_to_orig_map = token_to_orig_map
         self.span_to_orig_map: Dict[int, List[int]] = span_to_orig_map
 
         self.class_label = class_label
@@ -108,7 +138,47 @@ class IdentificationClassificationFeatures:
         self.valid_span_missing_in_context = valid_span_missing_in_context
         self.data_id = data_id
 
-        self.encoding = encoding
+        self.window_start = window_start
+        self.context_offset = context_offset
+        self.windows = windows
+        self.window_index = window_index
+
+    @property
+    def token_is_max_context(self) -> Dict[int, bool]:
+        """
+        Whether each context token (keyed by its position in input_ids) has
+        its maximum context in this window rather than in another window of
+        the example.
+        """
+        doc_spans = [{'start': start, 'paragraph_len': length} for start, length in self.windows]
+        return {
+            self.context_offset + j: _new_check_is_max_context(
+                doc_spans, self.window_index, self.window_start + j)
+            for j in range(self.paragraph_len)
+        }
+
+    def get_tokens(self, tokenizer, input_ids) -> List[str]:
+        """ Tokens of input_ids (e.g. a row of the dataset) without padding """
+        input_ids = list(input_ids)
+        if tokenizer.pad_token_id in input_ids:
+            if tokenizer.padding_side == "right":
+                input_ids = input_ids[: input_ids.index(tokenizer.pad_token_id)]
+            else:
+                last_padding_id_position = len(input_ids) - 1 - input_ids[::-1].index(tokenizer.pad_token_id)
+                input_ids = input_ids[last_padding_id_position + 1 :]
+        return tokenizer.convert_ids_to_tokens(input_ids)
+
+    def get_token_to_orig_map(self, document) -> Dict[int, int]:
+        """
+        Mapping from positions of context tokens in input_ids to the original
+        tokens, where document is the output of tokenize for the document.
+        """
+        tok_to_orig_index = document[2]
+        return {
+            self.context_offset + i: tok_to_orig_index[self.window_start + i]
+            for i in range(self.paragraph_len)
+            if tok_to_orig_index[self.window_start + i] != -1
+        }
 
 
 def _new_check_is_max_context(doc_spans, cur_span_index, position):
@@ -135,6 +205,97 @@ def _new_check_is_max_context(doc_spans, cur_span_index, position):
     return cur_span_index == best_span_index
 
 
+def plan_windows_greedy(
+        split_positions: List[int], n_tokens: int, max_context_length: int,
+        doc_stride: int) -> List[int]:
+    """
+    Plan context windows by sliding over the document. Each window begins
+    doc_stride tokens before the first span that the previous window did not
+    fully contain. Returns start positions of the windows.
+    """
+    window_starts = []
+    start = 0
+    covered_splits = set()
+    all_splits = set(split_positions)
+    while len(all_splits - covered_splits) > 0:
+        upcoming_splits = [i for i in split_positions
+                           if i >= start and i not in covered_splits]
+        assert len(upcoming_splits) > 0
+        second_split = upcoming_splits[1] if len(upcoming_splits) > 1 else n_tokens
+        if second_split - upcoming_splits[0] > max_context_length:
+            # a single span is larger than maximum allowed tokens ---- there are nothing we can do
+            start = upcoming_splits[0]
+            last_span_idx = second_split
+            covered_splits.add(upcoming_splits[0])
+        elif second_split - start > max_context_length:
+            # we can fit the first upcoming span if we modify "start"
+            start = second_split - max_context_length
+            last_span_idx = second_split
+            covered_splits.add(upcoming_splits[0])
+        else:
+            # we can fit at least one span
+            last_span_idx = None
+            for i in range(start, min(start + max_context_length, n_tokens) + 1):
+                if i == n_tokens or i in all_splits:
+                    if last_span_idx is not None:
+                        covered_splits.add(last_span_idx)
+                    last_span_idx = i
+            assert last_span_idx is not None
+        window_starts.append(start)
+        start = last_span_idx - doc_stride
+    return window_starts
+
+
+def plan_windows_optimal(
+        split_positions: List[int], n_tokens: int, max_context_length: int,
+        min_context: int) -> List[int]:
+    """
+    Plan the minimum number of context windows such that every span appears
+    in at least one window with at least min_context tokens on its left and
+    right (or up to the document boundary). Spans that cannot satisfy the
+    context requirement by themselves are centered in a window of their own.
+
+    Every window covers consecutive spans, so the minimum cover is found with
+    dynamic programming over span boundaries, where dp[j] is the minimum
+    number of windows to cover the first j spans. Returns start positions of
+    the windows.
+    """
+    n_spans = len(split_positions)
+    if n_spans == 0:
+        return []
+    span_ends = split_positions[1:] + [n_tokens]
+    lows = [max(0, s - min_context) for s in split_positions]
+    highs = [min(n_tokens, e + min_context) for e in span_ends]
+
+    dp = [0] + [n_spans + 1] * n_spans
+    back = [0] * (n_spans + 1)
+    for j in range(1, n_spans + 1):
+        for i in range(j - 1, -1, -1):
+            # A window can always hold a single span, possibly with less context
+            if j - i > 1 and highs[j - 1] - lows[i] > max_context_length:
+                break
+            if dp[i] + 1 < dp[j]:
+                dp[j] = dp[i] + 1
+                back[j] = i
+
+    groups = []
+    j = n_spans
+    while j > 0:
+        groups.append((back[j], j))
+        j = back[j]
+
+    window_starts = []
+    for i, j in reversed(groups):
+        if highs[j - 1] - lows[i] <= max_context_length:
+            lo, hi = lows[i], highs[j - 1]
+        else:
+            lo, hi = split_positions[i], span_ends[j - 1]
+        slack = max(max_context_length - (hi - lo), 0)
+        start = max(0, min(lo - slack // 2, n_tokens - max_context_length))
+        window_starts.append(start)
+    return window_starts
+
+
 def tokenize(tokenizer, tokens: List[str], splits: List[int]):
     tok_to_orig_index = []
     orig_to_tok_index = []
@@ -166,24 +327,73 @@ def tokenize(tokenizer, tokens: List[str], splits: List[int]):
     return all_doc_tokens, orig_to_tok_index, tok_to_orig_index, span_to_orig_index
 
 
+def group_by_document(keys: List[str]) -> Dict[str, List[int]]:
+    """ Indices of examples of each document in the order of appearance """
+    groups = OrderedDict()
+    for i, key in enumerate(keys):
+        groups.setdefault(key, []).append(i)
+    return groups
+
+
+def strip_example(example: ContractNLIExample) -> ContractNLIExample:
+    """
+    Shallow copy of an example without the document, which is sent to
+    workers once per document (already tokenized) rather than per hypothesis
+    """
+    example = copy.copy(example)
+    example.context_text = None
+    example.tokens = None
+    example.char_to_word_offset = None
+    return example
+
+
+def _truncated_query(example: ContractNLIExample, max_query_length: int,
+                     symbol_based_hypothesis: bool) -> List[str]:
+    if symbol_based_hypothesis:
+        return [example.hypothesis_symbol]
+    return tokenize(tokenizer, example.hypothesis_tokens, [])[0][:max_query_length]
+
+
+def _plan_windows(document, query_length: int, max_seq_length: int,
+                  doc_stride: int, segmentation: str, min_context: int):
+    """ Returns start positions and the maximum context length of windows """
+    all_doc_tokens, _, _, span_to_orig_index = document
+    sequence_pair_added_tokens = tokenizer.model_max_length - tokenizer.max_len_sentences_pair
+    max_context_length = max_seq_length - sequence_pair_added_tokens - query_length
+
+    split_positions = list(span_to_orig_index.keys())
+    if segmentation == 'greedy':
+        window_starts = plan_windows_greedy(
+            split_positions, len(all_doc_tokens), max_context_length, doc_stride)
+    elif segmentation == 'optimal':
+        window_starts = plan_windows_optimal(
+            split_positions, len(all_doc_tokens), max_context_length, min_context)
+    else:
+        raise ValueError(f'segmentation must be one of {SEGMENTATIONS}')
+    return window_starts, max_context_length
+
+
 def convert_example_to_features(
         example: ContractNLIExample,
+        document,
         max_seq_length: int,
         doc_stride: int,
         max_query_length: int,
         padding_strategy,
         labels_available: bool,
-        symbol_based_hypothesis: bool
+        symbol_based_hypothesis: bool,
+        segmentation: str = 'greedy',
+        min_context: int = 0
         ) -> List[IdentificationClassificationFeatures]:
+    """
+    Args:
+        document: Output of tokenize for the example's document
+    """
     features = []
 
-    all_doc_tokens, orig_to_tok_index, tok_to_orig_index, span_to_orig_index = tokenize(
-        tokenizer, example.tokens, example.splits)
+    all_doc_tokens, orig_to_tok_index, tok_to_orig_index, span_to_orig_index = document
 
-    if symbol_based_hypothesis:
-        truncated_query = [example.hypothesis_symbol]
-    else:
-        truncated_query = tokenize(tokenizer, example.hypothesis_tokens, [])[0][:max_query_length]
+    truncated_query = _truncated_query(example, max_query_length, symbol_based_hypothesis)
 
     # Tokenizers who insert 2 SEP tokens in-between <context> & <question> need to have special handling
     # in the way they compute mask of added tokens.
@@ -193,39 +403,15 @@ def convert_example_to_features(
         if tokenizer_type in MULTI_SEP_TOKENS_TOKENIZERS_SET
         else tokenizer.model_max_length - tokenizer.max_len_single_sentence
     )
-    sequence_pair_added_tokens = tokenizer.model_max_length - tokenizer.max_len_sentences_pair
     query_with_special_tokens_length = len(truncated_query) + sequence_added_tokens
-    max_context_length = max_seq_length - sequence_pair_added_tokens - len(truncated_query)
+    window_starts, max_context_length = _plan_windows(
+        document, len(truncated_query), max_seq_length, doc_stride,
+        segmentation, min_context)
 
-    spans = []
-    start = 0
-    covered_splits = set()
-    all_splits = set(span_to_orig_index.keys())
-    while len(all_splits - covered_splits) > 0:
-        upcoming_splits = [i for i in span_to_orig_index.keys()
-                           if i >= start and i not in covered_splits]
-        assert len(upcoming_splits) > 0
-        second_split = upcoming_splits[1] if len(upcoming_splits) > 1 else len(all_doc_tokens)
-        if second_split - upcoming_splits[0] > max_context_length:
-            # a single span is larger than maximum allowed tokens ---- there are nothing we can do
-            start = upcoming_splits[0]
-            last_span_idx = second_split
-            covered_splits.add(upcoming_splits[0])
-        elif second_split - start > max_context_length:
-            # we can fit the first upcoming span if we modify "start"
-            start = second_split - max_context_length
-            last_span_idx = second_split
-            covered_splits.add(upcoming_splits[0])
-        else:
-            # we can fit at least one span
-            last_span_idx = None
-            for i in range(start, min(start + max_context_length, len(all_doc_tokens)) + 1):
-                if i == len(all_doc_tokens) or i in span_to_orig_index:
-                    if last_span_idx is not None:
-                        covered_splits.add(last_span_idx)
-                    last_span_idx = i
-            assert last_span_idx is not None
+    context_offset = query_with_special_tokens_length if tokenizer.padding_side == "right" else 0
 
+    spans = []
+    for start in window_starts:
         split_tokens = all_doc_tokens[start:min(start + max_context_length, len(all_doc_tokens))]
 
         # Define the side we want to truncate / pad and the text/pair sorting
@@ -248,59 +434,28 @@ def convert_example_to_features(
         assert len(encoded_dict['input_ids']) <= max_seq_length
 
         paragraph_len = len(split_tokens)
-        if tokenizer.pad_token_id in encoded_dict["input_ids"]:
-            if tokenizer.padding_side == "right":
-                non_padded_ids = encoded_dict["input_ids"][: encoded_dict["input_ids"].index(tokenizer.pad_token_id)]
-            else:
-                last_padding_id_position = (
-                    len(encoded_dict["input_ids"]) - 1 - encoded_dict["input_ids"][::-1].index(tokenizer.pad_token_id)
-                )
-                non_padded_ids = encoded_dict["input_ids"][last_padding_id_position + 1 :]
-        else:
-            non_padded_ids = encoded_dict["input_ids"]
-
-        tokens = tokenizer.convert_ids_to_tokens(non_padded_ids)
-
-        token_to_orig_map = {}
         span_to_orig_map = {}
         for i in range(paragraph_len):
-            index = query_with_special_tokens_length + i if tokenizer.padding_side == "right" else i
+            index = context_offset + i
             if tok_to_orig_index[start + i] != -1:
-                token_to_orig_map[index] = tok_to_orig_index[start + i]
                 assert (start + i) not in span_to_orig_index
             else:
                 assert (start + i) in span_to_orig_index
                 span_to_orig_map[index] = span_to_orig_index[start + i]
 
         encoded_dict["paragraph_len"] = paragraph_len
-        encoded_dict["tokens"] = tokens
-        encoded_dict["token_to_orig_map"] = token_to_orig_map
         encoded_dict["span_to_orig_map"] = span_to_orig_map
         encoded_dict["truncated_query_with_special_tokens_length"] = query_with_special_tokens_length
-        encoded_dict["token_is_max_context"] = {}
         encoded_dict["start"] = start
 
         spans.append(encoded_dict)
 
-        start = last_span_idx - doc_stride
-
-    # Due to striding splitting, the same token will appear multiple times
-    # in different splits. We annotate data with "token_is_max_context"
-    # which classifies whether an instance of a token has the longest context
-    # amongst different instances of the same token.
-    for doc_span_index in range(len(spans)):
-        for j in range(spans[doc_span_index]["paragraph_len"]):
-            is_max_context = _new_check_is_max_context(
-                spans, doc_span_index, spans[doc_span_index]['start'] + j)
-            index = (
-                j
-                if tokenizer.padding_side == "left"
-                else query_with_special_tokens_length + j
-            )
-            spans[doc_span_index]["token_is_max_context"][index] = is_max_context
+    # tokens, token_to_orig_map and token_is_max_context of features are
+    # computed on demand from the windows
+    windows = tuple((span["start"], span["paragraph_len"]) for span in spans)
 
     span_token_id = tokenizer.additional_special_tokens_ids[tokenizer.additional_special_tokens.index(SPAN_TOKEN)]
-    for span in spans:
+    for window_index, span in enumerate(spans):
         # Identify the position of the CLS token
         cls_index = span["input_ids"].index(tokenizer.cls_token_id)
 
@@ -350,23 +505,82 @@ def convert_example_to_features(
                 example_index=0,  # Can not set unique_id and example_index here. They will be set after multiple processing.
                 unique_id=0,
                 paragraph_len=span["paragraph_len"],
-                token_is_max_context=span["token_is_max_context"],
-                tokens=span["tokens"],
-                token_to_orig_map=span["token_to_orig_map"],
                 span_to_orig_map=span["span_to_orig_map"],
                 class_label=class_label,
                 span_labels=span_labels,
                 valid_span_missing_in_context=valid_span_missing_in_context,
                 data_id=example.data_id,
+                window_start=span["start"],
+                context_offset=context_offset,
+                windows=windows,
+                window_index=window_index,
             )
         )
     return features
 
 
 
-def convert_example_to_features_init(tokenizer_for_convert: PreTrainedTokenizerBase):
-    global tokenizer
+def _column_types(max_seq_length: int, labels_available: bool, compact: bool) -> Dict[str, tuple]:
+    """ Name to (row shape, dtype) of each array stored in the dataset """
+    (_, p_mask_length), p_mask_dtype = p_mask_shape(1, max_seq_length, compact)
+    # Narrow types are widened on the device by the batch converters
+    columns = {
+        'input_ids': ((max_seq_length,), np.int32),
+        'attention_mask': ((max_seq_length,), np.int8),
+        'token_type_ids': ((max_seq_length,), np.int8),
+        'cls_index': ((), np.int32),
+        'p_mask': ((p_mask_length,), p_mask_dtype),
+        'valid_span_missing_in_context': ((), np.int8),
+    }
+    if labels_available:
+        columns.update({
+            'class_label': ((), np.int8),
+            'span_labels': ((max_seq_length,), np.int8),
+        })
+    return columns
+
+
+def _convert_document(task, *, columns: Dict[str, tuple], compact: bool, **kwargs):
+    """
+    Converts examples of a document in a single task, so that the document
+    is sent to a worker only once and its tokenization is never sent back.
+    The document is read from the tokenization cache or tokenized and added
+    to it. Returns the features of each example, which do not hold the
+    arrays, the rows of all features of the document in the dataset types
+    and whether the document was tokenized.
+    """
+    key, tokens, splits, examples = task
+    document = None if tokenization_cache is None else tokenization_cache.get(key)
+    tokenized = document is None
+    if tokenized:
+        document = tokenize(tokenizer, tokens, splits)
+        if tokenization_cache is not None:
+            tokenization_cache[key] = document
+    all_features = [
+        convert_example_to_features(example, document, **kwargs) for example in examples]
+    n_rows = sum(len(features) for features in all_features)
+    rows = {
+        name: np.empty((n_rows,) + shape, dtype=dtype)
+        for name, (shape, dtype) in columns.items()}
+    row = 0
+    for features in all_features:
+        for feature in features:
+            for name in columns:
+                value = getattr(feature, name)
+                if compact and name == 'p_mask':
+                    value = pack_mask(value)
+                rows[name][row] = value
+            for name in ARRAY_FIELDS:
+                setattr(feature, name, None)
+            row += 1
+    return all_features, rows, tokenized
+
+
+def convert_example_to_features_init(
+        tokenizer_for_convert: PreTrainedTokenizerBase, tokenization_cache_for_convert=None):
+    global tokenizer, tokenization_cache
     tokenizer = tokenizer_for_convert
+    tokenization_cache = tokenization_cache_for_convert
 
 
 def convert_examples_to_features(
@@ -380,6 +594,10 @@ def convert_examples_to_features(
     padding_strategy="max_length",
     threads=None,
     tqdm_enabled=True,
+    segmentation: str = 'greedy',
+    min_context: int = 0,
+    tokenization_cache=None,
+    compact: bool = False,
 ):
     """
     Converts a list of examples into a list of features that can be directly
@@ -394,29 +612,79 @@ def convert_examples_to_features(
         labels_available: whether to create features for model evaluation or model training.
         padding_strategy: Default to "max_length". Which padding strategy to use
         threads: multiple processing threads.
+        segmentation: How to split documents into windows. "greedy" slides
+            windows with doc_stride and "optimal" minimizes the number of
+            windows.
+        min_context: The minimum number of context tokens on each side of a
+            span when segmentation is "optimal".
+        tokenization_cache: Optional TokenizationCache of tokenized documents
+        compact: Store p_mask bit-packed (see pack_mask)
     """
+    if segmentation not in SEGMENTATIONS:
+        raise ValueError(f'segmentation must be one of {SEGMENTATIONS}')
     if threads is None or threads < 0:
-        threads = cpu_count()
+        threads = available_cpus()
     else:
-        threads = min(threads, cpu_count())
-    with Pool(threads, initializer=convert_example_to_features_init, initargs=(tokenizer,)) as p:
-        annotate_ = partial(
-            convert_example_to_features,
-            max_seq_length=max_seq_length,
-            doc_stride=doc_stride,
-            max_query_length=max_query_length,
-            padding_strategy=padding_strategy,
-            labels_available=labels_available,
-            symbol_based_hypothesis=symbol_based_hypothesis
-        )
-        features: List[List[IdentificationClassificationFeatures]] = list(
-            tqdm(
-                p.imap(annotate_, examples, chunksize=32),
-                total=len(examples),
-                desc="convert examples to features",
-                disable=not tqdm_enabled,
-            )
-        )
+        threads = min(threads, available_cpus())
+    keys = document_fingerprints(examples)
+    groups = group_by_document(keys)
+    columns = _column_types(max_seq_length, labels_available, compact)
+    convert_ = partial(
+        _convert_document,
+        columns=columns,
+        compact=compact,
+        max_seq_length=max_seq_length,
+        doc_stride=doc_stride,
+        max_query_length=max_query_length,
+        padding_strategy=padding_strategy,
+        labels_available=labels_available,
+        symbol_based_hypothesis=symbol_based_hypothesis,
+        segmentation=segmentation,
+        min_context=min_context
+    )
+    # Each document is sent once with its examples, which are stripped of it
+    tasks = (
+        (key, examples[indices[0]].tokens, examples[indices[0]].splits,
+         [strip_example(examples[i]) for i in indices])
+        for key, indices in groups.items())
+    features: List[List[IdentificationClassificationFeatures]] = [None] * len(examples)
+    blocks = []
+    n_tokenized = 0
+    with Pool(threads, initializer=convert_example_to_features_init,
+              initargs=(tokenizer, tokenization_cache)) as p:
+        for indices, (document_features, rows, tokenized) in zip(groups.values(), tqdm(
+                p.imap(convert_, tasks), total=len(groups),
+                desc="convert examples to features", disable=not tqdm_enabled)):
+            for i, example_features in zip(indices, document_features):
+                features[i] = example_features
+            blocks.append(rows)
+            n_tokenized += tokenized
+    if n_tokenized < len(groups):
+        logger.info(f'Reused {len(groups) - n_tokenized} cached tokenized documents')
+
+    # Rows of each document are moved into preallocated arrays in the order
+    # of examples, releasing each block once it is copied
+    counts = np.array([len(f) for f in features], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    arrays = {
+        name: np.empty((int(offsets[-1]),) + shape, dtype=dtype)
+        for name, (shape, dtype) in columns.items()}
+    for j, indices in enumerate(groups.values()):
+        rows = blocks[j]
+        blocks[j] = None
+        destination = np.concatenate(
+            [np.arange(offsets[i], offsets[i + 1]) for i in indices])
+        for name, array in arrays.items():
+            array[destination] = rows[name]
+    del blocks
+    arrays = {name: torch.from_numpy(a) for name, a in arrays.items()}
+    n_windows = np.array([len(f) for f in features if f])
+    if len(n_windows) > 0:
+        logger.info(
+            f'Segmented {len(n_windows)} examples into {n_windows.sum()} windows '
+            f'with "{segmentation}" segmentation (windows per example: '
+            f'mean {n_windows.mean():.2f}, max {n_windows.max()})')
+
     new_features = []
     unique_id = 1000000000
     example_index = 0
@@ -434,32 +702,21 @@ def convert_examples_to_features(
     features: List[IdentificationClassificationFeatures] = new_features
     del new_features
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_attention_masks = torch.tensor([f.attention_mask for f in features], dtype=torch.long)
-    all_token_type_ids = torch.tensor([f.token_type_ids for f in features], dtype=torch.long)
-    all_cls_index = torch.tensor([f.cls_index for f in features], dtype=torch.long)
-    all_p_mask = torch.tensor([f.p_mask for f in features], dtype=torch.float)
-    all_valid_span_missing_in_context = torch.tensor([f.valid_span_missing_in_context for f in features], dtype=torch.float)
-
-    all_feature_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
+    # Build dataset from the arrays, which are in the same order as features
+    all_feature_index = torch.arange(len(features), dtype=torch.long)
     dataset = [
-        all_input_ids,
-        all_attention_masks,
-        all_token_type_ids,
-        all_cls_index,
-        all_p_mask,
-        all_valid_span_missing_in_context,
+        arrays['input_ids'],
+        arrays['attention_mask'],
+        arrays['token_type_ids'],
+        arrays['cls_index'],
+        arrays['p_mask'],
+        arrays['valid_span_missing_in_context'],
         all_feature_index
     ]
     if labels_available:
-        all_class_label = torch.tensor(
-            [f.class_label for f in features], dtype=torch.long)
-        all_span_labels = torch.tensor(
-            [f.span_labels for f in features], dtype=torch.long)
         dataset += [
-            all_class_label,
-            all_span_labels,
+            arrays['class_label'],
+            arrays['span_labels'],
         ]
     dataset = TensorDataset(*dataset)
     return features, dataset
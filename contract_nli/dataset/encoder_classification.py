@@ -16,8 +16,8 @@
 # limitations under the License.
 
 from functools import partial
-from multiprocessing import Pool, cpu_count
-from typing import List
+from multiprocessing import Pool
+from typing import Dict, List
 
 import numpy as np
 import torch
@@ -26,15 +26,25 @@ from tqdm import tqdm
 from transformers.tokenization_utils_base import PreTrainedTokenizerBase
 from transformers.utils import logging
 
-from contract_nli.dataset.encoder import tokenize, SPAN_TOKEN
+from contract_nli.dataset.cache import document_fingerprints
+from contract_nli.dataset.encoder import SPAN_TOKEN, group_by_document, \
+    pack_mask, p_mask_shape, strip_example, tokenize
 from contract_nli.dataset.loader import ContractNLIExample, NLILabel
+from contract_nli.dataset.shared_arrays import SharedArrays
+from contract_nli.utils import available_cpus
 
 logger = logging.get_logger(__name__)
 
+# Per-example arrays that are stored in the dataset rather than in features
+# built by convert_examples_to_features
+ARRAY_FIELDS = ['input_ids', 'attention_mask', 'token_type_ids', 'p_mask']
+
 
 class ClassificationFeatures:
     """
-    Single example features to be fed to a model.
+    Single example features to be fed to a model. Features returned by
+    convert_examples_to_features do not hold the per-example arrays
+    (ARRAY_FIELDS are None), which are only stored in the dataset.
 
     Args:
         input_ids: Indices of input sequence tokens in the vocabulary.
@@ -76,24 +86,35 @@ class ClassificationFeatures:
         self.data_id = data_id
 
 
+def tokenize_span(tokenizer, tokens: List[str], splits: List[int], span: int) -> List[str]:
+    """
+    Subword tokens of a span without tokenizing the rest of the document.
+    Words are tokenized independently, so they are the same as the tokens of
+    the span in the output of tokenize for the whole document.
+    """
+    start = splits[span]
+    # The last span does not include the last word of the document, which
+    # keeps features identical to the ones built from whole documents
+    end = splits[span + 1] if span + 1 < len(splits) else len(tokens) - 1
+    return tokenize(tokenizer, tokens[start:end], [])[0]
+
+
 def convert_example_to_features(
         example: ContractNLIExample,
+        span_tokens: Dict[int, List[str]],
         max_seq_length: int,
         max_query_length: int,
         padding_strategy,
         symbol_based_hypothesis: bool
         ) -> ClassificationFeatures:
-    all_doc_tokens, orig_to_tok_index, tok_to_orig_index, span_to_orig_index = tokenize(
-       tokenizer, example.tokens, example.splits)
-
+    """
+    Args:
+        span_tokens: Output of tokenize_span for (at least) the annotated
+            spans of the example
+    """
     relevant_tokens = []
     for s in example.annotated_spans:
-        start_token_index = orig_to_tok_index[example.splits[s]]
-        if s + 1 < len(example.splits):
-            end_token_index = orig_to_tok_index[example.splits[s + 1]] - 1
-        else:
-            end_token_index = orig_to_tok_index[-1]
-        relevant_tokens.extend(all_doc_tokens[start_token_index:end_token_index])
+        relevant_tokens.extend(span_tokens[s])
     assert len(relevant_tokens) > 0 and SPAN_TOKEN not in relevant_tokens
 
     if symbol_based_hypothesis:
@@ -156,6 +177,36 @@ def convert_example_to_features(
     )
 
 
+def _fill_rows(task, *, spec, compact: bool, **kwargs):
+    """
+    Converts examples of a document and writes their arrays into the shared
+    arrays at the given rows. Only annotated spans that are not in
+    span_tokens are tokenized, once for all the examples (hypotheses).
+
+    Returns the features, which do not hold the arrays, and the newly
+    tokenized spans.
+    """
+    (tokens, splits, span_tokens), examples, rows = task
+    arrays = SharedArrays.open(spec)
+    new_span_tokens = dict()
+    features = []
+    for example, row in zip(examples, rows):
+        for s in example.annotated_spans:
+            if s not in span_tokens and s not in new_span_tokens:
+                new_span_tokens[s] = tokenize_span(tokenizer, tokens, splits, s)
+        feature = convert_example_to_features(
+            example, {**span_tokens, **new_span_tokens}, **kwargs)
+        for name in ['cls_index', 'class_label'] + ARRAY_FIELDS:
+            value = getattr(feature, name)
+            if compact and name == 'p_mask':
+                value = pack_mask(value)
+            arrays[name][row] = value
+        for name in ARRAY_FIELDS:
+            setattr(feature, name, None)
+        features.append(feature)
+    return features, new_span_tokens
+
+
 def convert_example_to_features_init(tokenizer_for_convert: PreTrainedTokenizerBase):
     global tokenizer
     tokenizer = tokenizer_for_convert
@@ -170,6 +221,8 @@ def convert_examples_to_features(
     padding_strategy="max_length",
     threads=None,
     tqdm_enabled=True,
+    tokenization_cache=None,
+    compact: bool = False,
 ):
     """
     Converts a list of examples into a list of features that can be directly
@@ -184,31 +237,65 @@ def convert_examples_to_features(
         labels_available: whether to create features for model evaluation or model training.
         padding_strategy: Default to "max_length". Which padding strategy to use
         threads: multiple processing threads.
+        tokenization_cache: Optional TokenizationCache, which holds tokenized
+            spans of each document
+        compact: Store p_mask bit-packed (see encoder.pack_mask)
     """
     if threads is None or threads < 0:
-        threads = cpu_count()
+        threads = available_cpus()
     else:
-        threads = min(threads, cpu_count())
+        threads = min(threads, available_cpus())
     n_orig_examples = len(examples)
     examples = [e for e in examples if e.label != NLILabel.NOT_MENTIONED]
     logger.warning(
         f'Removed examples with "na" labels ({n_orig_examples} -> {len(examples)})')
+    # Only annotated spans are tokenized (see tokenize_span) and they are
+    # cached per document, separately from whole tokenized documents
+    keys = ['spans_' + key for key in document_fingerprints(examples)]
+    groups = group_by_document(keys)
+    cached = dict() if tokenization_cache is None else tokenization_cache
+    documents = {
+        key: (examples[indices[0]].tokens, examples[indices[0]].splits,
+              cached.get(key, dict()))
+        for key, indices in groups.items()}
     with Pool(threads, initializer=convert_example_to_features_init, initargs=(tokenizer,)) as p:
-        annotate_ = partial(
-            convert_example_to_features,
-            max_seq_length=max_seq_length,
-            max_query_length=max_query_length,
-            padding_strategy=padding_strategy,
-            symbol_based_hypothesis=symbol_based_hypothesis
-        )
-        features: List[ClassificationFeatures] = list(
-            tqdm(
-                p.imap(annotate_, examples, chunksize=32),
-                total=len(examples),
-                desc="convert examples to features",
-                disable=not tqdm_enabled,
+        n_rows = len(examples)
+        # Narrow types are widened on the device by the batch converters
+        shapes = {
+            'input_ids': ((n_rows, max_seq_length), np.int32),
+            'attention_mask': ((n_rows, max_seq_length), np.int8),
+            'token_type_ids': ((n_rows, max_seq_length), np.int8),
+            'cls_index': ((n_rows,), np.int32),
+            'p_mask': p_mask_shape(n_rows, max_seq_length, compact),
+            'class_label': ((n_rows,), np.int8),
+        }
+        # Each example has a single feature, so example i is written to row i
+        with SharedArrays(shapes) as shared:
+            fill_ = partial(
+                _fill_rows,
+                spec=shared.spec,
+                compact=compact,
+                max_seq_length=max_seq_length,
+                max_query_length=max_query_length,
+                padding_strategy=padding_strategy,
+                symbol_based_hypothesis=symbol_based_hypothesis
             )
-        )
+            tasks = [
+                (documents[key], [strip_example(examples[i]) for i in indices], indices)
+                for key, indices in groups.items()]
+            features: List[ClassificationFeatures] = [None] * len(examples)
+            n_new_spans = 0
+            for (key, indices), (document_features, new_span_tokens) in zip(groups.items(), tqdm(
+                    p.imap(fill_, tasks), total=len(tasks),
+                    desc="convert examples to features", disable=not tqdm_enabled)):
+                for i, feature in zip(indices, document_features):
+                    features[i] = feature
+                if len(new_span_tokens) > 0:
+                    cached[key] = {**documents[key][2], **new_span_tokens}
+                    n_new_spans += len(new_span_tokens)
+            # Zero-copy; the mapped memory outlives the files removed on exit
+            arrays = {name: torch.from_numpy(a) for name, a in shared.arrays.items()}
+    logger.info(f'Tokenized {n_new_spans} annotated spans of {len(groups)} documents')
     new_features = []
     for example_index, example_features in enumerate(features):
         example_features.example_index = example_index
@@ -218,26 +305,16 @@ def convert_examples_to_features(
     del new_features
     assert len(features) == len(examples)
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_attention_masks = torch.tensor([f.attention_mask for f in features], dtype=torch.long)
-    all_token_type_ids = torch.tensor([f.token_type_ids for f in features], dtype=torch.long)
-    all_cls_index = torch.tensor([f.cls_index for f in features], dtype=torch.long)
-    all_p_mask = torch.tensor([f.p_mask for f in features], dtype=torch.float)
-
-    all_feature_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
-
-    all_class_label = torch.tensor(
-        [f.class_label for f in features], dtype=torch.long)
-
+    # Build dataset from the arrays, which are in the same order as features
+    all_feature_index = torch.arange(len(features), dtype=torch.long)
     dataset = [
-        all_input_ids,
-        all_attention_masks,
-        all_token_type_ids,
-        all_cls_index,
-        all_p_mask,
+        arrays['input_ids'],
+        arrays['attention_mask'],
+        arrays['token_type_ids'],
+        arrays['cls_index'],
+        arrays['p_mask'],
         all_feature_index,
-        all_class_label
+        arrays['class_label']
     ]
     dataset = TensorDataset(*dataset)
     return features, dataset
@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 import enum
 
 import tqdm
@@ -125,7 +125,15 @@ class ContractNLIExample:
 
     @classmethod
     def load(cls, input_data) -> List['ContractNLIExample']:
-        examples = []
+        return list(cls.iter_load(input_data))
+
+    @classmethod
+    def iter_load(cls, input_data) -> Iterator['ContractNLIExample']:
+        """
+        Yields examples document by document. input_data["documents"] may be
+        a generator (see contract_nli.dataset.reader.stream_dataset), so that
+        the whole dataset is never held in memory.
+        """
         label_dict = {
             label_id: label_info['hypothesis']
             for label_id, label_info in input_data['labels'].items()}
@@ -134,16 +142,17 @@ class ContractNLIExample:
                 raise RuntimeError(
                     f'{len(document["annotation_sets"])} annotation sets given but '
                     'we only support single annotation set.')
+            context_text = document['text']
+            # Shared by the examples (hypotheses) of the document
+            tokens, splits, char_to_word_offset = cls.tokenize_and_align(
+                context_text, document['spans'])
+            assert len(splits) == len(document['spans'])
             for label_id, annotation in document['annotation_sets'][0]['annotations'].items():
                 data_id = f'{document["id"]}_{label_id}'
-                context_text = document['text']
                 hypothesis_text = label_dict[label_id]
 
-                tokens, splits, char_to_word_offset = cls.tokenize_and_align(
-                    context_text, document['spans'])
                 hypothesis_tokens, _, _ = cls.tokenize_and_align(
                     hypothesis_text, [])
-                assert len(splits) == len(document['spans'])
                 example = cls(
                     data_id=data_id,
                     document_id=document["id"],
@@ -159,5 +168,4 @@ class ContractNLIExample:
                     label=NLILabel.from_str(annotation['choice']),
                     annotated_spans=annotation['spans']
                 )
-                examples.append(example)
-        return examples
+                yield example
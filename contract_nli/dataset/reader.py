@@ -0,0 +1,212 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import re
+from typing import Iterator, Optional, Tuple
+
+CHUNK_SIZE = 1 << 20
+
+_decoder = json.JSONDecoder()
+
+_BRACKET = re.compile(r'[\[\]{}]')
+_BRACKET_DEPTH = {'[': 1, '{': 1, ']': -1, '}': -1}
+
+# A JSONL line that may be {"labels": ...}
+_LABELS_LINE = re.compile(r'\s*\{\s*"labels"\s*:')
+
+
+def is_jsonl(path: str) -> bool:
+    return path.endswith('.jsonl')
+
+
+def _escaped(text: str, pos: int) -> bool:
+    """ Whether text[pos] is preceded by an odd number of backslashes """
+    backslashes = 0
+    while pos - backslashes > 0 and text[pos - backslashes - 1] == '\\':
+        backslashes += 1
+    return backslashes % 2 == 1
+
+
+class _JSONStream(object):
+    """ Decodes consecutive JSON values from a file with a growing buffer """
+
+    def __init__(self, fin):
+        self.fin = fin
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self, size: int) -> bool:
+        if self.eof:
+            return False
+        chunk = self.fin.read(size)
+        if len(chunk) == 0:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """ Next non-whitespace character ('' at the end of the file) """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._read(CHUNK_SIZE):
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars: str) -> str:
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError(f'Expected one of "{chars}" but got "{c}" in {self.fin.name}')
+        self.pos += 1
+        return c
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # A number may continue beyond the buffer
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Reads at least as much as buffered so that retries are amortized
+            self._read(max(CHUNK_SIZE, len(self.buffer) - self.pos))
+
+    def skip(self):
+        """
+        Skips the value of an object member by matching brackets without
+        decoding it. Only quotes are visited one by one and brackets between
+        strings are counted in bulk; as the value is followed by a key or
+        the end of the object, no bracket opens after it before the next
+        string.
+        """
+        if self.peek() not in ('[', '{'):
+            self.decode()
+            return
+        depth = 0
+        start = self.pos
+        while True:
+            quote = self.buffer.find('"', start)
+            end = len(self.buffer) if quote < 0 else quote
+            opened = self.buffer.count('[', start, end) + self.buffer.count('{', start, end)
+            closed = self.buffer.count(']', start, end) + self.buffer.count('}', start, end)
+            if depth + opened - closed <= 0:
+                # The value ends before the next string
+                for bracket in _BRACKET.finditer(self.buffer, start, end):
+                    depth += _BRACKET_DEPTH[bracket.group()]
+                    if depth == 0:
+                        self.pos = bracket.end()
+                        return
+            depth += opened - closed
+            if quote >= 0:
+                close = self.buffer.find('"', quote + 1)
+                while close >= 0 and self.buffer[close - 1] == '\\' and \
+                        _escaped(self.buffer, close):
+                    close = self.buffer.find('"', close + 1)
+                if close >= 0:
+                    start = close + 1
+                    continue
+            # Reads the rest of the string (if any) or the next chunk
+            self.pos = end
+            if not self._read(max(CHUNK_SIZE, len(self.buffer) - self.pos)):
+                raise ValueError(f'Unexpected end of {self.fin.name}')
+            start = self.pos
+
+
+def _iter_json_items(path: str, only: Optional[str] = None) -> Iterator[Tuple[str, object]]:
+    """
+    Yields ("documents", document) for each document and (key, value) for
+    the other top-level keys in the order of the file. Values of keys other
+    than only (if given) are skipped without being decoded.
+    """
+    with open(path) as fin:
+        stream = _JSONStream(fin)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.decode()
+            stream.expect(':')
+            if only is not None and key != only:
+                stream.skip()
+            elif key == 'documents':
+                stream.expect('[')
+                if stream.peek() == ']':
+                    stream.expect(']')
+                else:
+                    while True:
+                        yield key, stream.decode()
+                        if stream.expect(',]') == ']':
+                            break
+            else:
+                yield key, stream.decode()
+            if stream.expect(',}') == '}':
+                return
+
+
+def _iter_jsonl_items(path: str, only: Optional[str] = None) -> Iterator[Tuple[str, object]]:
+    with open(path) as fin:
+        for line in fin:
+            if line.strip() == '':
+                continue
+            if only == 'labels' and not _LABELS_LINE.match(line):
+                continue
+            obj = json.loads(line)
+            if 'labels' in obj and len(obj) == 1:
+                key, value = 'labels', obj['labels']
+            else:
+                key, value = 'documents', obj
+            if only is None or key == only:
+                yield key, value
+
+
+def _iter_items(path: str, only: Optional[str] = None) -> Iterator[Tuple[str, object]]:
+    if is_jsonl(path):
+        return _iter_jsonl_items(path, only=only)
+    return _iter_json_items(path, only=only)
+
+
+def iter_documents(path: str) -> Iterator[dict]:
+    for _, value in _iter_items(path, only='documents'):
+        yield value
+
+
+def load_labels(path: str) -> dict:
+    """
+    Returns "labels" of a dataset file. Documents before the labels are
+    skipped without being decoded.
+    """
+    for _, value in _iter_items(path, only='labels'):
+        return value
+    raise ValueError(f'{path} does not have "labels"')
+
+
+def stream_dataset(path: str) -> dict:
+    """
+    Reads a dataset file incrementally so that memory is bounded by the
+    largest document rather than the whole file. Returns the dataset with
+    "labels" loaded and "documents" as a generator, which can only be
+    iterated once.
+
+    Files are either JSON ({"documents": [...], "labels": {...}} in any key
+    order) or JSONL (*.jsonl) with one document per line and a line
+    {"labels": {...}}.
+    """
+    return {'labels': load_labels(path), 'documents': iter_documents(path)}
@@ -0,0 +1,96 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import shutil
+import tempfile
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Memory-mapped files in /dev/shm never touch the disk
+SHM_DIR = '/dev/shm'
+
+
+def _temp_root(nbytes: int) -> Optional[str]:
+    """
+    SHM_DIR if it has room for nbytes and otherwise None (i.e. the default
+    temporary directory). Writing beyond the size of /dev/shm (only 64MB on
+    docker by default) raises SIGBUS rather than an exception.
+    """
+    if not os.path.isdir(SHM_DIR):
+        return None
+    stat = os.statvfs(SHM_DIR)
+    available = stat.f_bavail * stat.f_frsize
+    if nbytes > available:
+        logger.warning(
+            f'{SHM_DIR} has only {available / 2 ** 20:.1f}MB free for '
+            f'{nbytes / 2 ** 20:.1f}MB of arrays; falling back to '
+            f'{tempfile.gettempdir()}')
+        return None
+    return SHM_DIR
+
+
+class SharedArrays(object):
+    """
+    Named numpy arrays backed by memory-mapped files that worker processes
+    fill in place. Workers only receive spec, which is a small picklable
+    description of the arrays, and open them with SharedArrays.open.
+
+    close() only removes the files, so arrays (and tensors created from them
+    with torch.from_numpy) stay valid as long as they are referenced.
+
+    Files are created in /dev/shm if it has enough free space and in the
+    default temporary directory otherwise.
+
+    Args:
+        shapes: Name to (shape, dtype) of each array
+    """
+
+    def __init__(self, shapes: Dict[str, Tuple[Tuple[int, ...], type]]):
+        nbytes = sum(
+            int(np.prod(shape)) * np.dtype(dtype).itemsize
+            for shape, dtype in shapes.values())
+        self.directory = tempfile.mkdtemp(prefix='contract_nli_', dir=_temp_root(nbytes))
+        self.spec = (self.directory, {
+            name: (tuple(shape), np.dtype(dtype).str)
+            for name, (shape, dtype) in shapes.items()})
+        # Creates the files
+        self.arrays = self.open(self.spec, mode='w+')
+
+    @staticmethod
+    def open(spec, mode: str = 'r+') -> Dict[str, np.ndarray]:
+        directory, shapes = spec
+        arrays = dict()
+        for name, (shape, dtype) in shapes.items():
+            if np.prod(shape) == 0:
+                # Empty files cannot be memory-mapped
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    os.path.join(directory, name), dtype=dtype, mode=mode, shape=shape)
+        return arrays
+
+    def close(self):
+        self.arrays = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
 from collections import defaultdict
 from typing import Dict, List, Union
 
@@ -137,6 +138,22 @@ def remove_not_mentioned(y_pred):
     return y_pred
 
 
+def get_metric(metrics: dict, name: str) -> float:
+    """ Looks up a metric by a dot-separated path such as "micro_label_micro_doc.span.map" """
+    value = metrics
+    for key in name.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            raise ValueError(f'Metric "{name}" is not found in the evaluation results')
+        value = value[key]
+    return value
+
+
+def required_ks(name: str) -> List[int]:
+    """ Returns ks that evaluate_all needs to compute a metric such as "precision@8" """
+    match = re.search(r'@(\d+)$', name)
+    return [int(match.group(1))] if match is not None else []
+
+
 def evaluate_all(
         dataset: dict,
         results: List[dict],
@@ -154,6 +171,8 @@ def evaluate_all(
     # if task in ['identification_classification', 'classification']:
     #     class_probs = defaultdict(list)
     #     class_labels = defaultdict(list)
+    # Documents are iterated only once so they may be a generator (see
+    # contract_nli.dataset.reader.stream_dataset)
     for document in dataset['documents']:
         result = id_to_result[document['id']]['annotation_sets'][0]['annotations']
         annotations = document['annotation_sets'][0]['annotations']
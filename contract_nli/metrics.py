@@ -0,0 +1,190 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import sklearn.metrics
+import torch
+
+_LOSSES = ['loss', 'loss_cls', 'loss_span']
+
+
+def _span_average_precision(probs: torch.Tensor, mask: torch.Tensor,
+                            labels: torch.Tensor) -> Optional[float]:
+    """ Average precision of spans in a batch (None if it is undefined) """
+    probs, mask, labels = probs.cpu().numpy(), mask.cpu().numpy(), labels.cpu().numpy().copy()
+    labels[:, 0] = 1
+    if len(set(labels.flat[mask.flat == 0])) > 1:
+        return sklearn.metrics.average_precision_score(
+            labels.flat[mask.flat == 0], probs.flat[mask.flat == 0])
+    return None
+
+
+class _PendingFlush(object):
+    def __init__(self, global_step: int, sums: torch.Tensor, counts: np.ndarray,
+                 span_batches: list, span_ap_sum: float, span_ap_count: int,
+                 extra: Dict[str, float], event=None):
+        self.global_step = global_step
+        self.sums = sums
+        self.counts = counts
+        self.span_batches = span_batches
+        self.span_ap_sum = span_ap_sum
+        self.span_ap_count = span_ap_count
+        self.extra = extra
+        self.event = event
+
+    def ready(self) -> bool:
+        return self.event is None or self.event.query()
+
+    def resolve(self) -> Dict[str, float]:
+        if self.event is not None:
+            self.event.synchronize()
+        sums = self.sums.numpy()
+        values = dict(self.extra)
+        for i, key in enumerate(_LOSSES + ['accuracy_nli']):
+            if self.counts[i] > 0:
+                values[key] = float(sums[i] / self.counts[i])
+        ap_sum, ap_count = self.span_ap_sum, self.span_ap_count
+        for batch in self.span_batches:
+            ap = _span_average_precision(*batch)
+            if ap is not None:
+                ap_sum += ap
+                ap_count += 1
+        if ap_count > 0:
+            values['map_span'] = float(ap_sum / ap_count)
+        return values
+
+
+class MetricsAccumulator(object):
+    """
+    Accumulates losses and NLI accuracy on the device so that recording a
+    batch never synchronizes with the host. Span MAP is costly, so logits of
+    only span_map_samples windows are kept every span_map_steps batches and
+    the MAP is computed when the metrics are resolved.
+
+    flush() starts a non-blocking copy of the accumulated values and returns
+    the flushes whose copies have finished, so on GPUs metrics are written
+    with a delay of (at most) one flush without stalling the training loop.
+
+    With eager_span_map, the MAP of each batch is computed when the batch is
+    recorded (synchronizing with the host) and its logits are dropped, so
+    that memory does not grow with the number of batches (e.g. validation).
+    Only then can all_reduce() combine the metrics of distributed processes.
+    """
+
+    def __init__(self, device, span_map_steps: int = 1,
+                 span_map_samples: Optional[int] = None,
+                 eager_span_map: bool = False):
+        if span_map_steps < 1:
+            raise ValueError('span_map_steps must be a positive integer')
+        self.device = device
+        self.span_map_steps = span_map_steps
+        self.span_map_samples = span_map_samples
+        self.eager_span_map = eager_span_map
+        self.pending: List[_PendingFlush] = []
+        self.n_updates = 0
+        self.reset()
+
+    def reset(self):
+        # losses followed by the number of correct NLI predictions
+        self.sums = torch.zeros(len(_LOSSES) + 1, device=self.device)
+        self.counts = np.zeros(len(_LOSSES) + 1, dtype=np.int64)
+        self.span_batches = []
+        # Sum and number of eagerly computed span APs
+        self.span_ap_sum = 0.0
+        self.span_ap_count = 0
+
+    def update(self, inputs: dict, outputs, loss, loss_cls=None, loss_span=None):
+        with torch.no_grad():
+            for i, value in enumerate([loss, loss_cls, loss_span]):
+                if value is not None:
+                    self.sums[i] += value.detach().float()
+                    self.counts[i] += 1
+            if loss_cls is not None:
+                class_labels = inputs['class_labels']
+                self.sums[-1] += (
+                    outputs.class_logits.detach().argmax(dim=1) == class_labels).sum()
+                self.counts[-1] += class_labels.numel()
+            if loss_span is not None and self.n_updates % self.span_map_steps == 0:
+                span_logits = outputs.span_logits.detach()
+                rows = slice(None)
+                if self.span_map_samples is not None and self.span_map_samples < len(span_logits):
+                    rows = torch.randperm(len(span_logits))[:self.span_map_samples].to(self.device)
+                batch = (
+                    torch.softmax(span_logits[rows].float(), dim=2)[:, :, 1],
+                    inputs['p_mask'][rows],
+                    inputs['span_labels'][rows]
+                )
+                if self.eager_span_map:
+                    ap = _span_average_precision(*batch)
+                    if ap is not None:
+                        self.span_ap_sum += ap
+                        self.span_ap_count += 1
+                else:
+                    self.span_batches.append(batch)
+        self.n_updates += 1
+
+    def all_reduce(self):
+        """
+        Sums the accumulated metrics over distributed processes so that the
+        flushed metrics cover the batches of all processes. This is a
+        collective call and requires eager_span_map.
+        """
+        if len(self.span_batches) > 0:
+            raise RuntimeError('all_reduce requires eager_span_map')
+        n = len(self.sums)
+        stats = torch.cat([
+            self.sums.double(),
+            torch.tensor(self.counts, dtype=torch.float64, device=self.device),
+            torch.tensor([self.span_ap_sum, self.span_ap_count],
+                         dtype=torch.float64, device=self.device)])
+        torch.distributed.all_reduce(stats)
+        self.sums = stats[:n].to(self.sums.dtype)
+        stats = stats[n:].cpu().numpy()
+        self.counts = stats[:n].round().astype(np.int64)
+        self.span_ap_sum = float(stats[n])
+        self.span_ap_count = int(round(stats[n + 1]))
+
+    def _copy_to_host(self, tensor: torch.Tensor) -> torch.Tensor:
+        if tensor.device.type != 'cuda':
+            return tensor.cpu()
+        host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        host.copy_(tensor, non_blocking=True)
+        return host
+
+    def flush(self, global_step: int, extra: Optional[Dict[str, float]] = None,
+              wait: bool = False) -> List[Tuple[int, Dict[str, float]]]:
+        """
+        Starts copying the accumulated metrics to the host and resets the
+        accumulator. Returns (global_step, metrics) of every flush that is
+        ready, or of every flush if wait is True.
+        """
+        if self.counts.sum() > 0 or len(self.span_batches) > 0 or self.span_ap_count > 0 or extra:
+            event = None
+            if self.sums.device.type == 'cuda':
+                event = torch.cuda.Event()
+            sums = self._copy_to_host(self.sums)
+            span_batches = [tuple(self._copy_to_host(t) for t in b) for b in self.span_batches]
+            if event is not None:
+                event.record()
+            self.pending.append(_PendingFlush(
+                global_step, sums, self.counts, span_batches, self.span_ap_sum,
+                self.span_ap_count, dict(extra or {}), event))
+            self.reset()
+        ready = []
+        while len(self.pending) > 0 and (wait or self.pending[0].ready()):
+            pending = self.pending.pop(0)
+            ready.append((pending.global_step, pending.resolve()))
+        return ready
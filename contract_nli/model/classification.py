@@ -13,7 +13,7 @@
 # limitations under the License.
 
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Sequence
 
 import torch
 from torch import nn
@@ -23,6 +23,8 @@ from transformers.utils import logging
 import numpy as np
 
 from contract_nli.dataset.loader import NLILabel
+from contract_nli.model.frozen_bottom import freeze_bottom_layers, \
+    bert_bottom_forward, bert_top_forward
 
 logger = logging.get_logger(__name__)
 
@@ -44,8 +46,24 @@ class BertForClassification(BertPreTrainedModel):
 
         self.model_type: str = config.model_type
 
+        self.num_frozen_layers = 0
+
         self.init_weights()
 
+    def freeze_bottom_layers(self, num_layers: int, trainable_token_ids: Sequence[int] = ()):
+        """
+        Freeze the embeddings (except for trainable_token_ids) and the bottom
+        num_layers encoder layers
+        """
+        freeze_bottom_layers(self.bert, num_layers, trainable_token_ids=trainable_token_ids)
+        self.num_frozen_layers = num_layers
+
+    def bottom_forward(self, input_ids, attention_mask=None, token_type_ids=None):
+        """ Outputs of the frozen layers that can be fed as bottom_hidden_states """
+        return bert_bottom_forward(
+            self.bert, self.num_frozen_layers, input_ids,
+            attention_mask=attention_mask, token_type_ids=token_type_ids)
+
     def forward(
         self,
         input_ids=None,
@@ -56,18 +74,31 @@ class BertForClassification(BertPreTrainedModel):
         inputs_embeds=None,
         class_labels=None,
         p_mask=None,
+        bottom_hidden_states=None,
     ) -> ClassificationModelOutput:
-        outputs = self.bert(
-            input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=False,
-            output_hidden_states=True,
-            return_dict=True,
-        )
+        if bottom_hidden_states is None and self.num_frozen_layers > 0:
+            if position_ids is not None or head_mask is not None or inputs_embeds is not None:
+                raise ValueError(
+                    'position_ids, head_mask and inputs_embeds are not supported with frozen layers')
+            # Frozen layers run in eval mode as in the activation cache
+            bottom_hidden_states = self.bottom_forward(
+                input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+        if bottom_hidden_states is not None:
+            outputs = bert_top_forward(
+                self.bert, self.num_frozen_layers, bottom_hidden_states,
+                attention_mask=attention_mask)
+        else:
+            outputs = self.bert(
+                input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=False,
+                output_hidden_states=True,
+                return_dict=True,
+            )
 
         pooled_output = outputs.pooler_output
         pooled_output = self.dropout(pooled_output)
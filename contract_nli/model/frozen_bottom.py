@@ -0,0 +1,106 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+from typing import Sequence
+
+import torch
+import torch.utils.checkpoint
+from transformers.modeling_outputs import \
+    BaseModelOutputWithPoolingAndCrossAttentions
+from transformers.models.bert import BertModel
+
+
+def freeze_bottom_layers(
+        bert: BertModel, num_layers: int, trainable_token_ids: Sequence[int] = ()):
+    """
+    Freezes the embeddings and the bottom num_layers encoder layers.
+    Embeddings of trainable_token_ids (e.g. newly added special tokens,
+    which are randomly initialized) are still trained by masking the
+    gradients of the other rows.
+    """
+    if not 0 <= num_layers <= len(bert.encoder.layer):
+        raise ValueError(
+            f'num_layers must be between 0 and {len(bert.encoder.layer)}')
+    for module in [bert.embeddings] + list(bert.encoder.layer[:num_layers]):
+        for param in module.parameters():
+            param.requires_grad = False
+
+    word_embeddings = bert.embeddings.word_embeddings
+    if getattr(word_embeddings, 'frozen_rows_hook', None) is not None:
+        word_embeddings.frozen_rows_hook.remove()
+        word_embeddings.frozen_rows_hook = None
+    if len(trainable_token_ids) > 0:
+        mask = torch.zeros(word_embeddings.num_embeddings, 1)
+        mask[list(trainable_token_ids)] = 1.0
+        word_embeddings.weight.requires_grad = True
+        word_embeddings.frozen_rows_hook = word_embeddings.weight.register_hook(
+            lambda grad: grad * mask.to(grad))
+
+
+@contextlib.contextmanager
+def _eval_mode(modules):
+    # Frozen layers run without dropout so that their outputs are deterministic
+    # and can be cached
+    modes = [m.training for m in modules]
+    for m in modules:
+        m.eval()
+    yield
+    for m, mode in zip(modules, modes):
+        m.train(mode)
+
+
+def bert_bottom_forward(
+        bert: BertModel, num_layers: int, input_ids, attention_mask=None,
+        token_type_ids=None) -> torch.Tensor:
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    extended_attention_mask = bert.get_extended_attention_mask(
+        attention_mask, input_ids.shape)
+    modules = [bert.embeddings] + list(bert.encoder.layer[:num_layers])
+    with _eval_mode(modules):
+        hidden_states = bert.embeddings(
+            input_ids=input_ids, token_type_ids=token_type_ids)
+        for layer in bert.encoder.layer[:num_layers]:
+            hidden_states = layer(
+                hidden_states, attention_mask=extended_attention_mask)[0]
+    return hidden_states
+
+
+def bert_top_forward(
+        bert: BertModel, num_layers: int, hidden_states, attention_mask=None
+        ) -> BaseModelOutputWithPoolingAndCrossAttentions:
+    hidden_states = hidden_states.to(bert.dtype)
+    if attention_mask is None:
+        attention_mask = torch.ones(
+            hidden_states.shape[:2], dtype=torch.long, device=hidden_states.device)
+    extended_attention_mask = bert.get_extended_attention_mask(
+        attention_mask, hidden_states.shape[:2])
+    checkpointing = getattr(bert.encoder, 'gradient_checkpointing', False) and bert.training
+    if checkpointing and torch.is_grad_enabled() and not hidden_states.requires_grad:
+        # Reentrant checkpointing only backpropagates through layers whose
+        # inputs require grad, which cached or frozen activations do not
+        hidden_states = hidden_states.detach().requires_grad_(True)
+    for layer in bert.encoder.layer[num_layers:]:
+        if checkpointing:
+            hidden_states = torch.utils.checkpoint.checkpoint(
+                layer, hidden_states, extended_attention_mask)[0]
+        else:
+            hidden_states = layer(
+                hidden_states, attention_mask=extended_attention_mask)[0]
+    pooled_output = bert.pooler(hidden_states) if bert.pooler is not None else None
+    return BaseModelOutputWithPoolingAndCrossAttentions(
+        last_hidden_state=hidden_states,
+        pooler_output=pooled_output
+    )
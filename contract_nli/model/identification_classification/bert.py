@@ -12,12 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import Sequence
+
 import torch
 from torch import nn
 from transformers.models.bert import BertPreTrainedModel, BertModel
 from transformers.utils import logging
 
 from contract_nli.dataset.loader import NLILabel
+from contract_nli.model.frozen_bottom import freeze_bottom_layers, \
+    bert_bottom_forward, bert_top_forward
 from contract_nli.model.identification_classification.model_output import \
     IdentificationClassificationModelOutput
 
@@ -44,8 +48,24 @@ class BertForIdentificationClassification(BertPreTrainedModel):
 
         self.class_loss_weight = config.class_loss_weight
 
+        self.num_frozen_layers = 0
+
         self.init_weights()
 
+    def freeze_bottom_layers(self, num_layers: int, trainable_token_ids: Sequence[int] = ()):
+        """
+        Freeze the embeddings (except for trainable_token_ids) and the bottom
+        num_layers encoder layers
+        """
+        freeze_bottom_layers(self.bert, num_layers, trainable_token_ids=trainable_token_ids)
+        self.num_frozen_layers = num_layers
+
+    def bottom_forward(self, input_ids, attention_mask=None, token_type_ids=None):
+        """ Outputs of the frozen layers that can be fed as bottom_hidden_states """
+        return bert_bottom_forward(
+            self.bert, self.num_frozen_layers, input_ids,
+            attention_mask=attention_mask, token_type_ids=token_type_ids)
+
     def forward(
         self,
         input_ids=None,
@@ -58,31 +78,51 @@ class BertForIdentificationClassification(BertPreTrainedModel):
         span_labels=None,
         p_mask=None,
         valid_span_missing_in_context=None,
+        bottom_hidden_states=None,
     ) -> IdentificationClassificationModelOutput:
-        outputs = self.bert(
-            input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=False,
-            output_hidden_states=True,
-            return_dict=True,
-        )
+        if bottom_hidden_states is None and self.num_frozen_layers > 0:
+            if position_ids is not None or head_mask is not None or inputs_embeds is not None:
+                raise ValueError(
+                    'position_ids, head_mask and inputs_embeds are not supported with frozen layers')
+            # Frozen layers run in eval mode as in the activation cache
+            bottom_hidden_states = self.bottom_forward(
+                input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+        if bottom_hidden_states is not None:
+            outputs = bert_top_forward(
+                self.bert, self.num_frozen_layers, bottom_hidden_states,
+                attention_mask=attention_mask)
+        else:
+            outputs = self.bert(
+                input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=False,
+                output_hidden_states=True,
+                return_dict=True,
+            )
 
         logits_cls, logits_span = None, None
         loss_cls, loss_span = None, None
 
-        if class_labels is not None and (type(class_labels) == torch.Tensor and (3 != class_labels).any()):
-        #     assert p_mask is not None
-        #     assert span_labels is not None
-            assert valid_span_missing_in_context is not None
+        # In training, a head is skipped when the batch gives it no loss
+        # (see has_unused_parameters). Otherwise (e.g. in validation with
+        # labels), logits are always computed for predictions.
+        has_loss_cls = class_labels is not None and (type(class_labels) == torch.Tensor and (3 != class_labels).any())
+        has_loss_span = span_labels is not None and (type(span_labels) == torch.Tensor and (-1 != span_labels).all())
 
+        if has_loss_cls or not self.training:
             pooled_output = outputs.pooler_output
             pooled_output = self.dropout(pooled_output)
             logits_cls = self.class_outputs(pooled_output)
 
+        if has_loss_cls:
+        #     assert p_mask is not None
+        #     assert span_labels is not None
+            assert valid_span_missing_in_context is not None
+
             loss_fct = nn.CrossEntropyLoss()
             if self.impossible_strategy == 'ignore':
                 class_labels = torch.where(
@@ -96,13 +136,14 @@ class BertForIdentificationClassification(BertPreTrainedModel):
                 )
             loss_cls = self.class_loss_weight * loss_fct(logits_cls, class_labels)
 
-        if span_labels is not None and (type(span_labels) == torch.Tensor and (-1 != span_labels).all()):
-            assert p_mask is not None
-
+        if has_loss_span or not self.training:
             sequence_output = outputs.last_hidden_state
             sequence_output = self.dropout(sequence_output)
             logits_span = self.span_outputs(sequence_output)
 
+        if has_loss_span:
+            assert p_mask is not None
+
             loss_fct = nn.CrossEntropyLoss()
             active_logits = logits_span.view(-1, 2)
             active_labels = torch.where(
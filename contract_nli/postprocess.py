@@ -13,7 +13,7 @@
 # limitations under the License.
 
 import collections
-from typing import List, Union, Optional
+from typing import Dict, List, Union, Optional
 
 import numpy as np
 from scipy.special import softmax
@@ -47,8 +47,16 @@ def compute_predictions_logits(
         all_features: List[IdentificationClassificationFeatures],
         all_results: List[IdentificationClassificationPartialResult],
         weight_class_probs_by_span_probs: bool,
-        calibration_coeff: Optional[float]
+        calibration_coeff: Optional[float],
+        precomputed_results: Optional[Dict[int, IdentificationClassificationResult]] = None
         ) -> List[IdentificationClassificationResult]:
+    """
+    precomputed_results: Results keyed by example index that did not go
+        through the model (e.g. gated by the cascade). They are returned
+        as-is.
+    """
+    if precomputed_results is None:
+        precomputed_results = dict()
     example_index_to_features = collections.defaultdict(list)
     for feature in all_features:
         example_index_to_features[feature.example_index].append(feature)
@@ -59,6 +67,9 @@ def compute_predictions_logits(
 
     results = []
     for example_index, example in enumerate(all_examples):
+        if example_index in precomputed_results:
+            results.append(precomputed_results[example_index])
+            continue
         features: List[IdentificationClassificationFeatures] = example_index_to_features[example_index]
         assert len(features) > 0
         span_probs = np.zeros((len(example.splits), 2))
@@ -147,6 +158,30 @@ def format_json(
     return sorted(documents.values(), key=lambda d: d['id'])
 
 
+def format_gold_json(all_examples: List[ContractNLIExample]) -> dict:
+    """ Reconstructs the gold dataset (as loaded from JSON) from examples """
+    documents = dict()
+    labels = dict()
+    for example in all_examples:
+        labels[example.hypothesis_id] = {'hypothesis': example.hypothesis_text}
+        if example.document_id not in documents:
+            documents[example.document_id] = {
+                'id': example.document_id,
+                'file_name': example.file_name,
+                'text': example.context_text,
+                'spans': example.spans,
+                'annotation_sets': [{'annotations': dict()}]
+            }
+        documents[example.document_id]['annotation_sets'][0]['annotations'][example.hypothesis_id] = {
+            'choice': example.label.to_anno_name(),
+            'spans': example.annotated_spans
+        }
+    return {
+        'documents': sorted(documents.values(), key=lambda d: d['id']),
+        'labels': labels
+    }
+
+
 def compute_prob_calibration_coeff(
         examples: List[ContractNLIExample],
         results: List[IdentificationClassificationResult]):
@@ -21,7 +21,7 @@ import logging
 from typing import List, Optional
 
 import torch
-from torch.utils.data import DataLoader, SequentialSampler
+from torch.utils.data import SequentialSampler, Subset
 from tqdm import tqdm
 import numpy as np
 from scipy.special import softmax
@@ -31,27 +31,62 @@ from contract_nli.model.identification_classification import \
 from contract_nli.postprocess import IdentificationClassificationPartialResult, \
     compute_predictions_logits, IdentificationClassificationResult, ClassificationResult
 from contract_nli.batch_converter import classification_converter, identification_classification_converter
+from contract_nli.cascade import NotMentionedGate
 from contract_nli.dataset.loader import NLILabel
+from contract_nli.prefetch import DevicePrefetcher, build_dataloader
+from contract_nli.utils import autocast
 
 logger = logging.getLogger(__name__)
 
 
-def to_list(tensor):
-    return tensor.detach().cpu().tolist()
+def to_partial_results(outputs: IdentificationClassificationModelOutput,
+                       feature_indices: List[int], features
+                       ) -> List[IdentificationClassificationPartialResult]:
+    # Copy logits of the whole batch at once instead of per feature
+    class_logits = outputs.class_logits.detach().float().cpu().numpy()
+    span_logits = outputs.span_logits.detach().float().cpu().numpy()
+    return [
+        IdentificationClassificationPartialResult(
+            int(features[feature_index].unique_id), class_logits[i], span_logits[i])
+        for i, feature_index in enumerate(feature_indices)
+    ]
 
 
 def predict(model, dataset, examples, features, *, per_gpu_batch_size: int,
             device, n_gpu: int, weight_class_probs_by_span_probs: bool,
-            calibration_coeff: Optional[float] = None
+            calibration_coeff: Optional[float] = None,
+            not_mentioned_gate: Optional[NotMentionedGate] = None,
+            gate_threshold: Optional[float] = None,
+            autocast_dtype: Optional[str] = None,
+            num_workers: int = 0
             ) -> List[IdentificationClassificationResult]:
     # We do not implement this as a part of Trainer, because we want to run
     # inference without instanizing optimizers
     eval_batch_size = per_gpu_batch_size * max(1, n_gpu)
 
+    # Cascaded inference: confident NotMentioned pairs skip the full model
+    gated_results = dict()
+    if not_mentioned_gate is not None and gate_threshold is not None:
+        gate_probs = not_mentioned_gate.predict_proba(examples)
+        for example_index, prob in enumerate(gate_probs):
+            if prob >= gate_threshold:
+                gated_results[example_index] = not_mentioned_gate.to_result(
+                    examples[example_index], prob)
+        logger.info(
+            f"  NotMentioned gate skipped {len(gated_results)}/{len(examples)} "
+            f"pairs ({len(gated_results) / max(1, len(examples)):.1%}) at "
+            f"threshold {gate_threshold}")
+        if len(gated_results) > 0:
+            dataset = Subset(dataset, [
+                i for i, f in enumerate(features)
+                if f.example_index not in gated_results])
+
     # Do not use DistributedSampler because it samples randomly
     eval_sampler = SequentialSampler(dataset)
-    eval_dataloader = DataLoader(
-        dataset, sampler=eval_sampler, batch_size=eval_batch_size)
+    eval_dataloader = build_dataloader(
+        dataset, device=device, num_workers=num_workers,
+        sampler=eval_sampler, batch_size=eval_batch_size)
+    prefetcher = DevicePrefetcher(eval_dataloader, device)
 
     # multi-gpu evaluate
     if n_gpu > 1 and not isinstance(model, torch.nn.DataParallel):
@@ -62,47 +97,41 @@ def predict(model, dataset, examples, features, *, per_gpu_batch_size: int,
     logger.info("  Batch size = %d", eval_batch_size)
 
     all_results = []
-    for batch in tqdm(eval_dataloader, desc="Evaluating"):
+    for batch in tqdm(prefetcher, desc="Evaluating"):
         model.eval()
         inputs = identification_classification_converter(batch, model, device, no_labels=True)
-        with torch.no_grad():
-
-            feature_indices = batch[6]
+        with torch.no_grad(), autocast(device, autocast_dtype):
+            feature_indices = batch[6].tolist()
             outputs: IdentificationClassificationModelOutput = model(**inputs)
 
-        for i, feature_index in enumerate(feature_indices):
-            eval_feature = features[feature_index.item()]
-            unique_id = int(eval_feature.unique_id)
-
-            class_logits = to_list(outputs.class_logits[i])
-            span_logits = to_list(outputs.span_logits[i])
-            result = IdentificationClassificationPartialResult(
-                unique_id, class_logits, span_logits)
-
-            all_results.append(result)
-
+        all_results.extend(to_partial_results(outputs, feature_indices, features))
+    logger.info(f"  Waited {prefetcher.wait_time:.1f} seconds for input")
 
     all_results = compute_predictions_logits(
         examples,
         features,
         all_results,
         weight_class_probs_by_span_probs=weight_class_probs_by_span_probs,
-        calibration_coeff=calibration_coeff
+        calibration_coeff=calibration_coeff,
+        precomputed_results=gated_results
     )
 
     return all_results
 
 
 def predict_classification(model, dataset, features, *, per_gpu_batch_size: int,
-                           device, n_gpu: int) -> List[ClassificationResult]:
+                           device, n_gpu: int, autocast_dtype: Optional[str] = None,
+                           num_workers: int = 0) -> List[ClassificationResult]:
     # We do not implement this as a part of Trainer, because we want to run
     # inference without instanizing optimizers
     eval_batch_size = per_gpu_batch_size * max(1, n_gpu)
 
     # Do not use DistributedSampler because it samples randomly
     eval_sampler = SequentialSampler(dataset)
-    eval_dataloader = DataLoader(
-        dataset, sampler=eval_sampler, batch_size=eval_batch_size)
+    eval_dataloader = build_dataloader(
+        dataset, device=device, num_workers=num_workers,
+        sampler=eval_sampler, batch_size=eval_batch_size)
+    prefetcher = DevicePrefetcher(eval_dataloader, device)
 
     # multi-gpu evaluate
     if n_gpu > 1 and not isinstance(model, torch.nn.DataParallel):
@@ -115,19 +144,20 @@ def predict_classification(model, dataset, features, *, per_gpu_batch_size: int,
     label_inds = [NLILabel.ENTAILMENT.value, NLILabel.CONTRADICTION.value]
 
     all_results = []
-    for batch in tqdm(eval_dataloader, desc="Evaluating"):
+    for batch in tqdm(prefetcher, desc="Evaluating"):
         model.eval()
         inputs = classification_converter(batch, model, device, no_labels=True)
-        with torch.no_grad():
-            feature_indices = batch[5]
+        with torch.no_grad(), autocast(device, autocast_dtype):
+            feature_indices = batch[5].tolist()
             outputs = model(**inputs)
 
         for i, feature_index in enumerate(feature_indices):
-            eval_feature = features[feature_index.item()]
-            class_logits = outputs.class_logits[i].detach().cpu()
+            eval_feature = features[feature_index]
+            class_logits = outputs.class_logits[i].detach().float().cpu()
             class_probs = np.zeros_like(class_logits)
             class_probs[label_inds] = softmax(class_logits[label_inds])
             result = ClassificationResult(eval_feature.data_id, class_probs.tolist())
             all_results.append(result)
+    logger.info(f"  Waited {prefetcher.wait_time:.1f} seconds for input")
 
     return all_results
\ No newline at end of file
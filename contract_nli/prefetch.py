@@ -0,0 +1,117 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import threading
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+
+def build_dataloader(dataset, *, device, num_workers: int = 0, **kwargs) -> DataLoader:
+    """ DataLoader with worker processes and pinned memory for CUDA devices """
+    if num_workers > 0:
+        kwargs.update({'num_workers': num_workers, 'persistent_workers': True})
+    return DataLoader(
+        dataset, pin_memory=device.type == 'cuda', **kwargs)
+
+
+class DevicePrefetcher(object):
+    """
+    Iterates over a DataLoader and yields batches that are already on the
+    device. The next batch is copied while the current step runs; on a side
+    CUDA stream from pinned memory on GPUs, and by a background thread
+    otherwise.
+
+    wait_time accumulates the seconds that the consumer waited for input.
+    """
+
+    def __init__(self, dataloader: DataLoader, device, prefetch: int = 2):
+        self.dataloader = dataloader
+        self.device = device
+        self.prefetch = prefetch
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._iter_cuda()
+        return self._iter_thread()
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(self.device)
+        current_stream = torch.cuda.current_stream(self.device)
+        iterator = iter(self.dataloader)
+
+        def load():
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return tuple(t.to(self.device, non_blocking=True) for t in batch)
+
+        next_batch = load()
+        while next_batch is not None:
+            start = time.perf_counter()
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            for t in batch:
+                # tell the allocator that the tensors are used on the current stream
+                t.record_stream(current_stream)
+            next_batch = load()
+            self.wait_time += time.perf_counter() - start
+            yield batch
+
+    def _iter_thread(self):
+        buffer = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def worker():
+            try:
+                for batch in self.dataloader:
+                    put(tuple(t.to(self.device) for t in batch))
+                    if stop.is_set():
+                        return
+            except Exception as e:
+                put(e)
+            put(end)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = buffer.get()
+                self.wait_time += time.perf_counter() - start
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,165 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Host-to-device copies are prefetched (see DevicePrefetcher), so waiting on
+# them is part of 'data'. 'convert' widens and unpacks the batch on the device.
+SECTIONS = ['data', 'convert', 'forward', 'backward', 'optimizer', 'logging']
+
+
+class StepTimer(object):
+    """
+    Accumulates wall-clock time of sections of training steps. CUDA kernels
+    run asynchronously, so their time is attributed to whichever section
+    happens to wait for them unless synchronize is True, which synchronizes
+    the device at every section boundary (accurate but slower).
+    """
+
+    def __init__(self, device, synchronize: bool = False):
+        self.synchronize = synchronize and device.type == 'cuda'
+        self.device = device
+        self.totals = OrderedDict((s, 0.0) for s in SECTIONS)
+        self.clear()
+
+    def clear(self):
+        """ Clears the times since the last logging (totals are kept) """
+        self.times = OrderedDict((s, 0.0) for s in SECTIONS)
+
+    def add(self, section: str, seconds: float):
+        self.times[section] = self.times.get(section, 0.0) + seconds
+        self.totals[section] = self.totals.get(section, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def section(self, section: str):
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+        start = time.perf_counter()
+        yield
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+        self.add(section, time.perf_counter() - start)
+
+
+class ThroughputMeter(object):
+    """
+    Counts processed windows and tokens. Real (non-padding) tokens are summed
+    on the device and only read by flush(), which takes the seconds spent on
+    training steps so that validation and checkpointing are not counted.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.total_windows = 0
+        self.total_tokens = 0
+        self.total_real_tokens = 0
+        self.total_seconds = 0.0
+        self.reset()
+
+    def reset(self):
+        self.windows = 0
+        self.tokens = 0
+        self.real_tokens = torch.zeros((), dtype=torch.long, device=self.device)
+
+    def update(self, attention_mask: torch.Tensor):
+        self.windows += attention_mask.shape[0]
+        self.tokens += attention_mask.numel()
+        self.real_tokens += attention_mask.detach().sum()
+
+    def flush(self, seconds: float) -> Dict[str, float]:
+        real_tokens = int(self.real_tokens.item())
+        self.total_windows += self.windows
+        self.total_tokens += self.tokens
+        self.total_real_tokens += real_tokens
+        self.total_seconds += seconds
+        values = self._values(self.windows, self.tokens, real_tokens, seconds)
+        self.reset()
+        return values
+
+    def summary(self) -> Dict[str, float]:
+        return self._values(
+            self.total_windows, self.total_tokens, self.total_real_tokens,
+            self.total_seconds)
+
+    @staticmethod
+    def _values(windows, tokens, real_tokens, seconds) -> Dict[str, float]:
+        if tokens == 0 or seconds == 0:
+            return dict()
+        return {
+            'windows_per_sec': windows / seconds,
+            'real_tokens_per_sec': real_tokens / seconds,
+            'padding_ratio': 1.0 - real_tokens / tokens
+        }
+
+
+class StepRangeProfiler(object):
+    """
+    Runs torch.profiler (or torch.autograd.profiler on older torches) from
+    global step start (inclusive) to end (exclusive) and exports a Chrome
+    trace to output_dir. Distributed processes pass their rank, which is
+    added to the file name so that processes do not overwrite each other.
+    """
+
+    def __init__(self, output_dir: str, step_range: Optional[Tuple[int, int]], device,
+                 rank: Optional[int] = None):
+        if step_range is not None and not 0 <= step_range[0] < step_range[1]:
+            raise ValueError('profile_steps must be [start, end] with 0 <= start < end')
+        self.output_dir = output_dir
+        self.step_range = step_range
+        self.device = device
+        self.rank = rank
+        self.profiler = None
+
+    def _create(self):
+        if hasattr(torch, 'profiler'):
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            return torch.profiler.profile(
+                activities=activities, record_shapes=True, profile_memory=True)
+        return torch.autograd.profiler.profile(
+            use_cuda=self.device.type == 'cuda', record_shapes=True, profile_memory=True)
+
+    def step(self, global_step: int):
+        """ Must be called at every global step """
+        if self.step_range is None:
+            return
+        start, end = self.step_range
+        if global_step == start and self.profiler is None:
+            logger.info(f'Starting profiler at step {global_step}')
+            self.profiler = self._create()
+            self.profiler.__enter__()
+        elif global_step >= end:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        suffix = '' if self.rank is None else f'_rank{self.rank}'
+        path = os.path.join(
+            self.output_dir,
+            f'profile_trace_{self.step_range[0]}-{self.step_range[1]}{suffix}.json')
+        self.profiler.export_chrome_trace(path)
+        logger.info(f'Saved profiler trace to {path}')
+        self.profiler = None
@@ -0,0 +1,125 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+from typing import Optional
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class CheckpointableSampler(Sampler):
+    """
+    A random sampler that can resume from the middle of an epoch. The
+    permutation of each epoch is derived from (seed, epoch), so the sampler
+    state is just the seed, the epoch and the number of samples already
+    consumed in that epoch. When num_replicas is larger than one, it shards
+    the permutation in the same way as DistributedSampler.
+
+    num_samples overrides the number of samples per replica, which lets
+    processes with datasets of different sizes (e.g. sharded features) run
+    the same number of steps. The permutation is padded by repeating it.
+    """
+
+    def __init__(self, data_source, num_replicas: Optional[int] = None,
+                 rank: Optional[int] = None, shuffle: bool = True, seed: int = 0,
+                 num_samples: Optional[int] = None):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() \
+                if torch.distributed.is_initialized() else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() \
+                if torch.distributed.is_initialized() else 0
+        self.data_source = data_source
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        if num_samples is None:
+            num_samples = int(math.ceil(len(data_source) / num_replicas))
+        elif num_samples * num_replicas < len(data_source):
+            raise ValueError('num_samples must cover the whole data_source')
+        self.num_samples = num_samples
+        self.total_size = self.num_samples * num_replicas
+        self.epoch = 0
+        self.start = 0
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.data_source), generator=g).tolist()
+        else:
+            indices = list(range(len(self.data_source)))
+        # add extra samples to make it evenly divisible among replicas
+        padding_size = self.total_size - len(indices)
+        indices += (indices * math.ceil(padding_size / max(len(indices), 1)))[:padding_size]
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.start = 0
+
+    def state_dict(self) -> dict:
+        return {'seed': self.seed, 'epoch': self.epoch, 'start': self.start}
+
+    def load_state_dict(self, state_dict: dict):
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+        self.start = state_dict['start']
+        if self.start >= self.num_samples:
+            self.epoch += 1
+            self.start = 0
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Deterministic batch sampler for inference. Windows are sorted by their
+    lengths (longest first) so that each batch contains windows of similar
+    lengths and can be trimmed to its longest window. When num_replicas is
+    larger than one, batches are assigned to replicas in a round-robin manner.
+
+    Args:
+        lengths: Number of non-padding tokens of each window
+        batch_size: Maximum number of windows in a batch
+        indices: Subset of windows to iterate over. All windows are used if None
+    """
+
+    def __init__(self, lengths, batch_size: int, indices=None,
+                 num_replicas: Optional[int] = None, rank: Optional[int] = None):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() \
+                if torch.distributed.is_initialized() else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() \
+                if torch.distributed.is_initialized() else 0
+        lengths = np.asarray(lengths)
+        if indices is None:
+            indices = np.arange(len(lengths))
+        indices = np.asarray(indices)
+        indices = indices[np.argsort(-lengths[indices], kind='stable')].tolist()
+        batches = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+        self.batches = batches[rank::num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
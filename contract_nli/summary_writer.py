@@ -12,30 +12,97 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import defaultdict
+import logging
+import queue
+import threading
+
 from torch.utils.tensorboard import SummaryWriter as _SummaryWriter
 
+logger = logging.getLogger(__name__)
+
+REDUCTIONS = {'count', 'sum', 'min', 'max', 'mean'}
+
+
+class _RunningStat(object):
+    __slots__ = ['count', 'sum', 'min', 'max']
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value, num: int):
+        self.count += num
+        self.sum += value * num
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def reduce(self, reduction: str):
+        if self.count == 0:
+            return None
+        if reduction == 'mean':
+            return self.sum / self.count
+        return getattr(self, reduction)
+
 
 class SummaryWriter(object):
-    def __init__(self, path: str, reduce_func=None):
-        if reduce_func is None:
-            reduce_func = lambda values: (sum(values) / len(values) if len(values) > 0 else None)
+    """
+    Reduces scalars between write() calls with running statistics, so memory
+    does not grow with the number of values added. Events are written to
+    TensorBoard by a background thread, which is stopped by close().
+    """
+
+    def __init__(self, path: str, reduction: str = 'mean'):
+        if reduction not in REDUCTIONS:
+            raise ValueError(f'reduction must be one of {REDUCTIONS}')
         self.tb_writer = _SummaryWriter(path)
-        self.reduce_func = reduce_func
+        self.reduction = reduction
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
         self.clear()
 
-    def __del__(self):
-            self.tb_writer.close()
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.tb_writer.add_scalar(*item)
+            except Exception:
+                # Keeps consuming the queue so that flush() does not block
+                logger.exception(f'Failed to write {item[0]} to TensorBoard')
+            finally:
+                self.queue.task_done()
 
     def clear(self):
-        self.state = defaultdict(list)
+        self.state = dict()
 
     def add_scalar(self, key, value, num: int=1):
-        self.state[key].extend([value] * num)
+        if key not in self.state:
+            self.state[key] = _RunningStat()
+        self.state[key].add(value, num)
+
+    def add_scalars(self, scalars: dict, global_step, prefix: str = ''):
+        # Writes already reduced values directly at the given global_step
+        for key, val in scalars.items():
+            self.queue.put((prefix + key, val, global_step))
 
     def write(self, global_step):
-        for key, values in self.state.items():
-            val = self.reduce_func(values)
+        for key, stat in self.state.items():
+            val = stat.reduce(self.reduction)
             if val is not None:
-                self.tb_writer.add_scalar(key, val, global_step)
+                self.queue.put((key, val, global_step))
         self.clear()
+
+    def flush(self):
+        """ Blocks until all pending events are written to the disk """
+        self.queue.join()
+        self.tb_writer.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            self.tb_writer.close()
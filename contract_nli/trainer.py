@@ -16,23 +16,32 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import contextlib
 import glob
 import json
 import logging
 import os
-from typing import Optional
+import resource
+from typing import Optional, Sequence, Tuple
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, RandomSampler
-from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 from transformers import AdamW, get_linear_schedule_with_warmup
-import sklearn.metrics
-import scipy.special
 
-from contract_nli.batch_converter import classification_converter, identification_classification_converter
+from contract_nli.activation_cache import ActivationCache
+from contract_nli.evaluation import evaluate_all, get_metric, required_ks
+from contract_nli.checkpoint import CheckpointWriter, checkpoint_step, to_cpu
+from contract_nli.batch_converter import classification_converter, identification_classification_converter, \
+    trim_padding_collate
+from contract_nli.metrics import MetricsAccumulator
+from contract_nli.postprocess import compute_predictions_logits, format_gold_json, format_json
+from contract_nli.predictor import to_partial_results
+from contract_nli.profiling import StepRangeProfiler, StepTimer, ThroughputMeter
+from contract_nli.prefetch import DevicePrefetcher, build_dataloader
+from contract_nli.sampler import CheckpointableSampler, LengthBucketBatchSampler
 from contract_nli.summary_writer import SummaryWriter
+from contract_nli.utils import autocast, check_autocast, inference_mode
 
 logger = logging.getLogger(__name__)
 
@@ -53,6 +62,28 @@ def setup_optimizer(model, learning_rate: float, epsilon: float, weight_decay: f
     return AdamW(optimizer_grouped_parameters, lr=learning_rate, eps=epsilon)
 
 
+def exclude_from_weight_decay(optimizer, param: torch.nn.Parameter):
+    """ Moves param to a new parameter group without weight decay """
+    for group in optimizer.param_groups:
+        if group['weight_decay'] > 0 and any(p is param for p in group['params']):
+            group['params'] = [p for p in group['params'] if p is not param]
+            optimizer.add_param_group({'params': [param], 'weight_decay': 0.0})
+            return
+
+
+def has_unused_parameters(dataset, task: str) -> bool:
+    """
+    Whether some batches may leave model parameters unused. The class head
+    (and the pooler) of identification_classification models is skipped
+    when all windows in a batch have the NONE label, and the span head is
+    skipped when any window has span_labels[0] == -1.
+    """
+    if task != 'identification_classification':
+        return False
+    class_labels, span_labels = dataset.tensors[7], dataset.tensors[8]
+    return bool((class_labels == 3).any() or (span_labels[:, 0] == -1).any())
+
+
 class Trainer(object):
     def __init__(
             self, *, model, train_dataset, optimizer, task: str, output_dir: str,
@@ -60,24 +91,72 @@ class Trainer(object):
             dev_dataset=None, valid_steps: Optional[int]=None, per_gpu_dev_batch_size: Optional[int]=None,
             gradient_accumulation_steps: int=1, warmup_steps: int=0, max_grad_norm: Optional[float]=None,
             n_gpu: int=1, local_rank: int=-1, fp16: bool=False, fp16_opt_level=None, device=torch.device("cpu"),
-            save_steps: Optional[int] = None):
+            save_steps: Optional[int] = None, frozen_layers: int = 0, activation_cache: bool = False,
+            trainable_token_ids: Sequence[int] = (),
+            autocast_dtype: Optional[str] = None, seed: int = 0, num_workers: int = 0,
+            logging_steps: int = 1, span_map_steps: int = 1, span_map_samples: Optional[int] = None,
+            dev_subsample: Optional[int] = None, dev_examples=None, dev_features=None,
+            validation_metric: Optional[str] = None, weight_class_probs_by_span_probs: bool = False,
+            early_stopping_patience: Optional[int] = None, early_stopping_min_delta: float = 0.0,
+            save_total_limit: Optional[int] = None, timer_cuda_sync: bool = False,
+            profile_steps: Optional[Tuple[int, int]] = None,
+            find_unused_parameters: Optional[bool] = None,
+            train_dataset_sharded: bool = False):
         if local_rank in [-1, 0]:
             self.tb_writer = SummaryWriter(os.path.join(output_dir, 'tensorboard'))
         if task not in ['identification_classification', 'classification']:
             raise ValueError("task must be either 'classification' or 'identification_classification'")
 
         train_batch_size = per_gpu_train_batch_size * max(1, n_gpu)
-        train_sampler = RandomSampler(train_dataset) if local_rank == -1 else DistributedSampler(train_dataset)
-        self.train_dataloader = DataLoader(
-            train_dataset, sampler=train_sampler, batch_size=train_batch_size)
+        if train_dataset_sharded and local_rank != -1:
+            # Each process holds its own shard of features (see
+            # load_and_cache_features_sharded). Shards are padded to the
+            # largest one so that all processes run the same number of steps.
+            stats = torch.tensor(
+                [len(train_dataset), int(has_unused_parameters(train_dataset, task))],
+                dtype=torch.long, device=device)
+            torch.distributed.all_reduce(stats, op=torch.distributed.ReduceOp.MAX)
+            self.train_sampler = CheckpointableSampler(
+                train_dataset, num_replicas=1, rank=0, seed=seed,
+                num_samples=int(stats[0]))
+            if find_unused_parameters is None:
+                # All processes must agree on find_unused_parameters
+                find_unused_parameters = bool(stats[1])
+        else:
+            # Shards the dataset when torch.distributed is initialized
+            self.train_sampler = CheckpointableSampler(train_dataset, seed=seed)
+        self.train_dataloader = build_dataloader(
+            train_dataset, device=device, num_workers=num_workers,
+            sampler=self.train_sampler, batch_size=train_batch_size)
+        # number of samples consumed in the current epoch
+        self.sampler_position = 0
 
         if dev_dataset is not None:
             if per_gpu_dev_batch_size is None:
                 per_gpu_dev_batch_size = per_gpu_train_batch_size
             dev_batch_size = per_gpu_dev_batch_size * max(1, n_gpu)
-            dev_sampler = RandomSampler(dev_dataset) if local_rank == -1 else DistributedSampler(dev_dataset)
-            self.dev_dataloader = DataLoader(
-                dev_dataset, sampler=dev_sampler, batch_size=dev_batch_size)
+            if validation_metric is not None:
+                if task != 'identification_classification':
+                    raise ValueError('validation_metric is only supported for identification_classification')
+                if dev_examples is None or dev_features is None:
+                    raise ValueError('validation_metric requires dev_examples and dev_features')
+                if dev_subsample is not None:
+                    raise ValueError('validation_metric requires predictions for all dev windows '
+                                     'and cannot be used with dev_subsample')
+            dev_indices = None
+            if dev_subsample is not None and dev_subsample < len(dev_dataset):
+                # The same subset is used in every validation
+                dev_indices = np.sort(np.random.RandomState(seed).choice(
+                    len(dev_dataset), dev_subsample, replace=False))
+            # Shards batches when torch.distributed is initialized. Metrics
+            # need predictions of all windows, so every process runs the
+            # whole dev set instead of gathering predictions.
+            dev_batch_sampler = LengthBucketBatchSampler(
+                dev_dataset.tensors[1].sum(dim=1), dev_batch_size, indices=dev_indices,
+                **({'num_replicas': 1, 'rank': 0} if validation_metric is not None else {}))
+            self.dev_dataloader = build_dataloader(
+                dev_dataset, device=device, num_workers=num_workers,
+                batch_sampler=dev_batch_sampler, collate_fn=trim_padding_collate)
         else:
             self.dev_dataloader = None
 
@@ -88,6 +167,11 @@ class Trainer(object):
         else:
             num_epochs = (max_steps * gradient_accumulation_steps) // len(self.train_dataloader)
 
+        if frozen_layers > 0 and len(trainable_token_ids) > 0:
+            # Only the rows of trainable_token_ids are updated (see
+            # freeze_bottom_layers) and the others must not be decayed either.
+            # This must precede the scheduler, which schedules existing groups.
+            exclude_from_weight_decay(optimizer, model.get_input_embeddings().weight)
         scheduler = get_linear_schedule_with_warmup(
             optimizer, num_warmup_steps=warmup_steps, num_training_steps=max_steps
         )
@@ -98,6 +182,15 @@ class Trainer(object):
         self.max_steps = max_steps
         self.fp16 = fp16
         self.fp16_opt_level = fp16_opt_level
+        if fp16 and autocast_dtype is not None:
+            raise ValueError('fp16 (apex) and autocast_dtype cannot be used together')
+        check_autocast(device, autocast_dtype)
+        self.autocast_dtype = autocast_dtype
+        self.grad_scaler = None
+        if autocast_dtype == 'float16':
+            # bfloat16 has the same exponent range as float32 and does not
+            # need loss scaling
+            self.grad_scaler = torch.cuda.amp.GradScaler()
         self.gradient_accumulation_steps = gradient_accumulation_steps
         self.device = device
         self.n_gpu = n_gpu
@@ -107,14 +200,68 @@ class Trainer(object):
         self.per_gpu_train_batch_size = per_gpu_train_batch_size
         self.output_dir = output_dir
         self.save_steps = save_steps
+        self.checkpoint_writer = CheckpointWriter(output_dir, save_total_limit=save_total_limit)
+        self.step_timer = StepTimer(device, synchronize=timer_cuda_sync)
+        self.throughput = ThroughputMeter(device)
+        self.profiler = StepRangeProfiler(
+            output_dir, profile_steps, device,
+            rank=torch.distributed.get_rank() if local_rank != -1 else None)
+        self.last_profile_step = 0
+        self.logging_steps = logging_steps
+        self.validation_metric = validation_metric
+        if validation_metric is not None:
+            self.dev_examples = dev_examples
+            self.dev_features = dev_features
+            self.dev_gold = format_gold_json(dev_examples)
+            self.weight_class_probs_by_span_probs = weight_class_probs_by_span_probs
+        # Only the top process logs training metrics
+        self.train_metrics = MetricsAccumulator(
+            device, span_map_steps=span_map_steps, span_map_samples=span_map_samples)
         self.task = task
         if self.task == 'identification_classification':
             self.converter = identification_classification_converter
         else:
             self.converter = classification_converter
 
+        self.frozen_layers = frozen_layers
+        self.trainable_token_ids = list(trainable_token_ids)
+        self.activation_cache = None
+        if frozen_layers > 0:
+            if not hasattr(self.model, 'freeze_bottom_layers'):
+                raise ValueError(
+                    f'frozen_layers is not supported for {type(self.model).__name__}')
+            self.model.freeze_bottom_layers(
+                frozen_layers, trainable_token_ids=self.trainable_token_ids)
+            if activation_cache and len(self.trainable_token_ids) > 0:
+                raise ValueError(
+                    'activation_cache cannot be used while embeddings of added tokens '
+                    'are trained, as they change the cached activations')
+            if activation_cache:
+                rank = torch.distributed.get_rank() if local_rank != -1 else 0
+                self.activation_cache = ActivationCache(
+                    os.path.join(output_dir, f'activation_cache_{rank}.npy'),
+                    train_dataset.tensors[0], train_dataset.tensors[2],
+                    hidden_size=self.model.config.hidden_size)
+        elif activation_cache:
+            raise ValueError('activation_cache requires frozen_layers > 0')
+
+        if find_unused_parameters is None:
+            find_unused_parameters = has_unused_parameters(train_dataset, task)
+        self.find_unused_parameters = find_unused_parameters
+
         self.global_step = 0
         self.best_loss = np.inf
+        # Only used with validation_metric, which is maximized
+        self.best_metric = -np.inf
+
+        # Stops training when validation does not improve by more than
+        # early_stopping_min_delta for early_stopping_patience evaluations
+        if early_stopping_patience is not None and dev_dataset is None:
+            raise ValueError('early_stopping_patience requires dev_dataset')
+        self.early_stopping_patience = early_stopping_patience
+        self.early_stopping_min_delta = early_stopping_min_delta
+        self.evals_without_improvement = 0
+        self.stop_reason = None
 
         self.deployed = False
 
@@ -145,12 +292,27 @@ class Trainer(object):
 
         # Distributed training (should be after apex fp16 initialization)
         if self.local_rank != -1:
+            # device_ids must not be set for CPU modules
+            device_kwargs = dict()
+            if self.device.type == 'cuda':
+                device_kwargs = {'device_ids': [self.local_rank], 'output_device': self.local_rank}
             self.model = torch.nn.parallel.DistributedDataParallel(
-                self.model, device_ids=[self.local_rank], output_device=self.local_rank,
-                find_unused_parameters=True
+                self.model, find_unused_parameters=self.find_unused_parameters, **device_kwargs
             )
+            logger.info(
+                f"  All-reduce volume = {self.allreduce_mb:.1f} MB per optimizer step "
+                f"(find_unused_parameters={self.find_unused_parameters})")
         self.deployed = True
 
+    @property
+    def allreduce_mb(self) -> float:
+        """ Size of gradients all-reduced by DistributedDataParallel per optimizer step """
+        if self.local_rank == -1:
+            return 0.0
+        return sum(
+            p.numel() * p.element_size() for p in self.model.parameters()
+            if p.requires_grad) / 1024 ** 2
+
     @property
     def n_samples(self):
         return len(self.train_dataloader)
@@ -187,82 +349,260 @@ class Trainer(object):
             desc=f"Train (epoch {self.current_epoch + 1})", disable=not self.is_top, position=0, leave=True
         )
         step = 0
+        checked_top_layer_grads = False
         self.val_losses = dict()
-        while (self.global_step + 1) <= self.max_steps:
-            if self.local_rank != -1:
-                self.train_dataloader.sampler.set_epoch(self.current_epoch)
-            pbar.set_description(desc=f"Train (epoch {self.current_epoch + 1})")
-            for batch in self.train_dataloader:
-                # Skip past any already trained steps if resuming training
-                if (step // self.gradient_accumulation_steps) < self.current_step:
-                    step += 1
-                    continue
-
-                loss = self.run_batch(batch, train=True)
-
-                if self.gradient_accumulation_steps > 1:
-                    loss = loss / self.gradient_accumulation_steps
-
-                if self.fp16:
-                    with self.amp.scale_loss(loss, self.optimizer) as scaled_loss:
-                        scaled_loss.backward()
-                else:
-                    loss.backward()
-
-                if (step + 1) % self.gradient_accumulation_steps == 0:
-                    if self.max_grad_norm is not None:
+        self.val_metrics = dict()
+        self.stop_reason = None
+        self.last_profile_step = self.global_step
+        self.profiler.step(self.global_step)
+        while (self.global_step + 1) <= self.max_steps and self.stop_reason is None:
+            pbar.set_description(desc=f"Train (epoch {self.train_sampler.epoch + 1})")
+            # Resumes from the middle of the epoch without replaying batches
+            epoch_start = self.train_sampler.start
+            prefetcher = DevicePrefetcher(self.train_dataloader, self.device)
+            last_wait_time = 0.0
+            last_step_wait_time = 0.0
+            for i, batch in enumerate(prefetcher):
+                self.step_timer.add('data', prefetcher.wait_time - last_step_wait_time)
+                last_step_wait_time = prefetcher.wait_time
+                self.sampler_position = min(
+                    epoch_start + (i + 1) * self.train_dataloader.batch_size,
+                    len(self.train_sampler))
+
+                # Gradients are all-reduced only on the last micro-step of
+                # gradient accumulation
+                sync_gradients = (step + 1) % self.gradient_accumulation_steps == 0
+                with self.model.no_sync() if self.local_rank != -1 and not sync_gradients \
+                        else contextlib.nullcontext():
+                    loss, _ = self.run_batch(
+                        batch, train=True, metrics=self.train_metrics if self.is_top else None)
+
+                    if self.gradient_accumulation_steps > 1:
+                        loss = loss / self.gradient_accumulation_steps
+
+                    with self.step_timer.section('backward'):
                         if self.fp16:
-                            torch.nn.utils.clip_grad_norm_(
-                                self.amp.master_params(self.optimizer), self.max_grad_norm)
+                            with self.amp.scale_loss(loss, self.optimizer) as scaled_loss:
+                                scaled_loss.backward()
+                        elif self.grad_scaler is not None:
+                            self.grad_scaler.scale(loss).backward()
+                        else:
+                            loss.backward()
+
+                if sync_gradients:
+                    with self.step_timer.section('optimizer'):
+                        if self.max_grad_norm is not None:
+                            if self.fp16:
+                                torch.nn.utils.clip_grad_norm_(
+                                    self.amp.master_params(self.optimizer), self.max_grad_norm)
+                            else:
+                                if self.grad_scaler is not None:
+                                    self.grad_scaler.unscale_(self.optimizer)
+                                torch.nn.utils.clip_grad_norm_(
+                                    self.model.parameters(), self.max_grad_norm)
+
+                        if self.frozen_layers > 0 and not checked_top_layer_grads:
+                            self.check_top_layer_grads()
+                            checked_top_layer_grads = True
+
+                        if self.grad_scaler is not None:
+                            self.grad_scaler.step(self.optimizer)
+                            self.grad_scaler.update()
                         else:
-                            torch.nn.utils.clip_grad_norm_(
-                                self.model.parameters(), self.max_grad_norm)
-
-                    self.optimizer.step()
-                    self.scheduler.step()  # Update learning rate schedule
-                    self.model.zero_grad()
-                    if self.is_top:
-                        self.tb_writer.write(self.global_step)
+                            self.optimizer.step()
+                        self.scheduler.step()  # Update learning rate schedule
+                        self.model.zero_grad()
+                    with self.step_timer.section('logging'):
+                        if self.is_top:
+                            self.tb_writer.add_scalar('train/data_wait_time', prefetcher.wait_time - last_wait_time)
+                            if (self.global_step + 1) % self.logging_steps == 0:
+                                self.tb_writer.write(self.global_step)
+                                # Peaks are not averaged over the steps
+                                self.tb_writer.add_scalars(
+                                    self.memory_stats(), self.global_step, prefix='train/')
+                                self.write_metrics(
+                                    self.train_metrics, 'train',
+                                    extra={'lr': self.scheduler.get_last_lr()[0]})
+                                self.write_profile()
+                    last_wait_time = prefetcher.wait_time
                     self.global_step += 1
+                    self.profiler.step(self.global_step)
                     pbar.update()
 
                     if self.dev_dataloader is not None and self.global_step % self.valid_steps == 0:
-                        loss = self.evaluate()
-                        self.val_losses[self.global_step] = loss
-                        if loss < self.best_loss:
-                            self.best_loss = loss
-                            if self.is_top:
-                                self.save(self.best_checkpoint_dir)
+                        values = self.evaluate()
+                        self.val_losses[self.global_step] = values['loss']
+                        if self.validation_metric is not None:
+                            self.val_metrics[self.global_step] = values[self.validation_metric]
+                        if self.update_best(values) and self.is_top:
+                            self.save(self.best_checkpoint_dir)
+                        if self.early_stopping_patience is not None and \
+                                self.evals_without_improvement >= self.early_stopping_patience:
+                            self.stop_reason = 'early_stopping'
+                            logger.info(
+                                f'Validation has not improved for {self.evals_without_improvement} '
+                                f'evaluations. Stopping at step {self.global_step}/{self.max_steps}.')
 
                     if self.is_top and self.save_steps > 0 and self.global_step % self.save_steps == 0:
                         self.save()
                 step += 1
-                if (self.global_step + 1) >= self.max_steps:
+                if (self.global_step + 1) >= self.max_steps or self.stop_reason is not None:
                     break
+            self.train_sampler.set_epoch(self.train_sampler.epoch + 1)
+            self.sampler_position = 0
+        self.profiler.stop()
+        if self.is_top:
+            self.write_metrics(self.train_metrics, 'train', wait=True)
+            self.write_profile()
+            self.tb_writer.flush()
+            self.checkpoint_writer.wait()
+            self.save_profile_summary()
+        if self.stop_reason is None:
+            self.stop_reason = 'max_steps'
         with open(os.path.join(self.output_dir, 'val_losses.json'), 'w') as fout:
             json.dump(self.val_losses, fout, indent=2)
+        if self.is_top:
+            with open(os.path.join(self.output_dir, 'trainer_info.json'), 'w') as fout:
+                json.dump(self.trainer_info, fout, indent=2)
+        if self.validation_metric is not None:
+            with open(os.path.join(self.output_dir, 'val_metrics.json'), 'w') as fout:
+                json.dump(self.val_metrics, fout, indent=2)
+        if self.activation_cache is not None:
+            self.activation_cache.close()
+            self.activation_cache = None
         pbar.close()
 
+    def close(self):
+        """ Waits for pending checkpoints and stops the TensorBoard writer """
+        if self.is_top:
+            self.checkpoint_writer.wait()
+            self.tb_writer.close()
+
+    def check_top_layer_grads(self):
+        """
+        Raises if the lowest trainable encoder layer received no gradients,
+        e.g. because gradient checkpointing was cut off by frozen inputs
+        """
+        model = self.model.module if hasattr(self.model, 'module') else self.model
+        layers = model.bert.encoder.layer
+        if self.frozen_layers >= len(layers):
+            return
+        for param in layers[self.frozen_layers].parameters():
+            if param.grad is not None and bool(torch.any(param.grad != 0)):
+                return
+        raise RuntimeError(
+            f'Encoder layer {self.frozen_layers} (the lowest layer that is not '
+            'frozen) received no gradients')
+
     def evaluate(self):
+        prefetcher = DevicePrefetcher(self.dev_dataloader, self.device)
         epoch_iterator = tqdm(
-            self.dev_dataloader, desc="Iteration (dev)", disable=not self.is_top)
-        if self.is_top:
-            self.tb_writer.clear()
-        losses = []
-        for _, batch in enumerate(epoch_iterator):
-            loss = self.run_batch(batch, train=False)
-            losses.append(loss.item())
+            prefetcher, desc="Iteration (dev)", disable=not self.is_top)
+        partial_results = []
+        with inference_mode():
+            # Span MAP is computed per batch so that logits are not kept
+            metrics = MetricsAccumulator(self.device, eager_span_map=True)
+            for _, batch in enumerate(epoch_iterator):
+                _, outputs = self.run_batch(batch, train=False, metrics=metrics)
+                if self.validation_metric is not None:
+                    partial_results.extend(to_partial_results(
+                        outputs, batch[6].tolist(), self.dev_features))
+        if self.local_rank != -1:
+            # Each process evaluated a shard of the dev batches (or all of
+            # them with validation_metric, in which case averages are the same)
+            metrics.all_reduce()
+        (_, values), = metrics.flush(
+            self.global_step, extra={'data_wait_time': prefetcher.wait_time}, wait=True)
+        if self.validation_metric is not None:
+            values[self.validation_metric] = self.compute_validation_metric(partial_results)
         if self.is_top:
-            self.tb_writer.write(self.global_step)
-        return np.mean(losses)
-
-    def run_batch(self, batch, train: bool):
+            self.tb_writer.add_scalars(values, self.global_step, prefix='eval/')
+        return values
+
+    def compute_validation_metric(self, partial_results) -> float:
+        # Same post-processing as the prediction after training, without
+        # writing results to the disk
+        results = compute_predictions_logits(
+            self.dev_examples, self.dev_features, partial_results,
+            weight_class_probs_by_span_probs=self.weight_class_probs_by_span_probs,
+            calibration_coeff=None)
+        metrics = evaluate_all(
+            self.dev_gold, format_json(self.dev_examples, results),
+            required_ks(self.validation_metric), self.task)
+        return float(get_metric(metrics, self.validation_metric))
+
+    def update_best(self, values: dict) -> bool:
+        """
+        Returns True if the validation result is the best so far. Improvements
+        not larger than early_stopping_min_delta count towards the patience.
+        """
+        if self.validation_metric is None:
+            improvement = self.best_loss - values['loss']
+        else:
+            improvement = values[self.validation_metric] - self.best_metric
+        improved = improvement > 0
+        if improvement > self.early_stopping_min_delta:
+            self.evals_without_improvement = 0
+        else:
+            self.evals_without_improvement += 1
+        if improved:
+            self.best_loss = values['loss']
+            if self.validation_metric is not None:
+                self.best_metric = values[self.validation_metric]
+        return improved
+
+    def write_profile(self):
+        """ Writes section times per optimizer step and throughput since the last call """
+        times = self.step_timer.times
+        n_steps = self.global_step + 1 - self.last_profile_step
+        self.last_profile_step = self.global_step + 1
+        values = self.throughput.flush(sum(times.values()))
+        if n_steps > 0:
+            values.update({f'time_{k}': v / n_steps for k, v in times.items()})
+        if self.local_rank != -1:
+            values['allreduce_mb'] = self.allreduce_mb
+        self.step_timer.clear()
+        self.tb_writer.add_scalars(values, self.global_step, prefix='profile/')
+
+    def save_profile_summary(self):
+        totals = self.step_timer.totals
+        total = sum(totals.values())
+        summary = {
+            'seconds': dict(totals),
+            'fractions': {k: (v / total if total > 0 else 0.0) for k, v in totals.items()},
+            **self.throughput.summary()
+        }
+        with open(os.path.join(self.output_dir, 'profile_summary.json'), 'w') as fout:
+            json.dump(summary, fout, indent=2)
+
+    def write_metrics(self, metrics: MetricsAccumulator, prefix: str,
+                      extra: Optional[dict] = None, wait: bool = False):
+        for global_step, values in metrics.flush(self.global_step, extra=extra, wait=wait):
+            self.tb_writer.add_scalars(values, global_step, prefix=f'{prefix}/')
+
+    def run_batch(self, batch, train: bool, metrics: Optional[MetricsAccumulator] = None):
+        """ Returns the loss and the model outputs """
         if train:
             self.model.train()
         else:
             self.model.eval()
-        inputs = self.converter(batch, self.model, self.device)
-        outputs = self.model(**inputs)
+        # Only training steps are profiled
+        section = self.step_timer.section if train else (lambda _: contextlib.nullcontext())
+        with section('convert'):
+            inputs = self.converter(batch, self.model, self.device)
+        if train:
+            self.throughput.update(inputs['attention_mask'])
+        model = self.model
+        if not train and isinstance(model, torch.nn.parallel.DistributedDataParallel):
+            # Forward passes of DistributedDataParallel are collective (buffers
+            # are broadcast), but processes may run different numbers of dev
+            # batches
+            model = model.module
+        with section('forward'):
+            if train and self.activation_cache is not None:
+                inputs['bottom_hidden_states'] = self.cached_bottom_forward(batch, inputs)
+            with autocast(self.device, self.autocast_dtype):
+                outputs = model(**inputs)
 
         loss, loss_cls = outputs.loss, outputs.loss_cls
         loss_span = None
@@ -275,60 +615,98 @@ class Trainer(object):
             if self.task == 'identification_classification':
                 loss_span = loss_span.mean()
 
-        if self.is_top:
-            prefix = 'train' if train else 'eval'
-            self.tb_writer.add_scalar(f"{prefix}/lr", self.scheduler.get_last_lr()[0])
-            self.tb_writer.add_scalar(f"{prefix}/loss", loss.item())
-            if loss_cls is not None:
-                self.tb_writer.add_scalar(f"{prefix}/loss_cls", loss_cls.item())
-                self.tb_writer.add_scalar(
-                    f'{prefix}/accuracy_nli',
-                    (np.argmax(outputs.class_logits.detach().cpu().numpy(), axis=1) == inputs['class_labels'].cpu().numpy()).mean())
-            if self.task == 'identification_classification' and loss_span is not None:
-                self.tb_writer.add_scalar(f"{prefix}/loss_span", loss_span.item())
-                mask = inputs['p_mask'].cpu().numpy()
-                probs = scipy.special.softmax(outputs.span_logits.detach().cpu().numpy(), axis=2)[:, :, 1]
-                labels = inputs['span_labels'].cpu().numpy().copy()
-                labels[:, 0] = 1
-                if len(set(labels.flat[mask.flat == 0])) > 1:
-                    self.tb_writer.add_scalar(
-                        f'{prefix}/map_span',
-                        sklearn.metrics.average_precision_score(
-                            labels.flat[mask.flat == 0],
-                            probs.flat[mask.flat == 0]))
-
-        return loss
+        if metrics is not None:
+            metrics.update(inputs, outputs, loss, loss_cls=loss_cls, loss_span=loss_span)
+
+        return loss, outputs
+
+    def cached_bottom_forward(self, batch, inputs) -> torch.Tensor:
+        # feature indices are stored right after the dataset's inputs
+        feature_index_pos = 6 if self.task == 'identification_classification' else 5
+        feature_indices = batch[feature_index_pos].cpu().numpy()
+        missing = self.activation_cache.missing(feature_indices)
+        if missing.any():
+            model = self.model.module if hasattr(self.model, "module") else self.model
+            mask = torch.from_numpy(missing).to(self.device)
+            with torch.no_grad():
+                hidden_states = model.bottom_forward(
+                    inputs['input_ids'][mask],
+                    attention_mask=inputs['attention_mask'][mask],
+                    token_type_ids=inputs['token_type_ids'][mask] if 'token_type_ids' in inputs else None)
+            self.activation_cache.put(feature_indices[missing], hidden_states)
+        return self.activation_cache.get(feature_indices).to(self.device)
+
+    def memory_stats(self) -> dict:
+        """
+        Peak allocated memory since the last call on GPUs ("peak_memory_mb").
+        On CPUs, the peak resident set size over the lifetime of the process
+        ("max_rss_mb") as it cannot be reset.
+        """
+        if self.device.type == 'cuda':
+            peak = torch.cuda.max_memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return {'peak_memory_mb': peak / 1024 ** 2}
+        # ru_maxrss is in kilobytes on Linux
+        return {'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
 
     @property
     def best_checkpoint_dir(self) -> str:
         return os.path.join(self.output_dir, f"best-checkpoint")
 
-    def save(self, checkpoint_dir: Optional[str] = None):
+    def save(self, checkpoint_dir: Optional[str] = None, wait: bool = False):
+        """
+        Snapshots the states to CPU memory and writes them in the background.
+        Call checkpoint_writer.wait() (or pass wait=True) before reading the
+        checkpoint.
+        """
         if checkpoint_dir is None:
             checkpoint_dir = os.path.join(
                 self.output_dir, f"checkpoint-{self.global_step}")
         # Take care of distributed/parallel training
         logger.info("Saving model checkpoint to %s", checkpoint_dir)
         model_to_save = self.model.module if hasattr(self.model, "module") else self.model
-        model_to_save.save_pretrained(checkpoint_dir)
-        logger.info("Saving optimizer and scheduler states to %s", checkpoint_dir)
-        torch.save(self.optimizer.state_dict(), os.path.join(checkpoint_dir, "optimizer.pt"))
-        torch.save(self.scheduler.state_dict(), os.path.join(checkpoint_dir, "scheduler.pt"))
-
-        with open(os.path.join(checkpoint_dir, 'trainer_info.json'), 'w') as fout:
-            json.dump({
-                'global_step': self.global_step,
-                'best_loss': self.best_loss,
-                'task': self.task
-            }, fout, indent=2)
-        logger.info("Finished saving Trainer.")
+        # Waits for the previous write before taking a new snapshot so that
+        # only one snapshot is held in memory
+        self.checkpoint_writer.wait()
+        states = {
+            "optimizer.pt": to_cpu(self.optimizer.state_dict()),
+            "scheduler.pt": to_cpu(self.scheduler.state_dict())
+        }
+        if self.grad_scaler is not None:
+            states["scaler.pt"] = to_cpu(self.grad_scaler.state_dict())
+        self.checkpoint_writer.write(
+            checkpoint_dir, model_to_save, to_cpu(model_to_save.state_dict()),
+            states, self.trainer_info)
+        if wait:
+            self.checkpoint_writer.wait()
+
+    @property
+    def trainer_info(self) -> dict:
+        info = {
+            'global_step': self.global_step,
+            'best_loss': self.best_loss,
+            'best_metric': self.best_metric,
+            'evals_without_improvement': self.evals_without_improvement,
+            'task': self.task,
+            'sampler': {**self.train_sampler.state_dict(), 'start': self.sampler_position}
+        }
+        if self.stop_reason is not None:
+            info.update({
+                'stop_reason': self.stop_reason,
+                'steps_saved': self.max_steps - self.global_step
+            })
+        return info
 
     def resume(self, output_dir: str):
-        checkpoint_dirs = glob.glob(os.path.join(output_dir, 'checkpoint-*'))
-        checkpoint_dir = max(checkpoint_dirs, key=lambda d: int(d.split("-")[-1]))
+        # Skips directories of unfinished writes (e.g. "checkpoint-100.tmp")
+        checkpoint_dirs = [
+            d for d in glob.glob(os.path.join(output_dir, 'checkpoint-*'))
+            if d.split("-")[-1].isdigit()]
+        checkpoint_dir = max(checkpoint_dirs, key=checkpoint_step)
         self.load(checkpoint_dir)
 
     def load(self, checkpoint_dir):
+        self.checkpoint_writer.wait()
         with open(os.path.join(checkpoint_dir, 'trainer_info.json')) as fin:
             trainer_info = json.load(fin)
         self.global_step = trainer_info['global_step']
@@ -338,9 +716,23 @@ class Trainer(object):
                 'the corresponding checkpoint was not found at '
                 f'{self.best_checkpoint_dir}. Resetting it to inf.')
             self.best_loss = np.inf
+            self.best_metric = -np.inf
         else:
             self.best_loss = trainer_info['best_loss']
+            self.best_metric = trainer_info.get('best_metric', -np.inf)
+        self.evals_without_improvement = trainer_info.get('evals_without_improvement', 0)
         self.task = trainer_info['task']
+        if 'sampler' in trainer_info:
+            self.train_sampler.load_state_dict(trainer_info['sampler'])
+        else:
+            # Checkpoints without sampler states resume from the same step
+            # of the epoch with a new permutation
+            self.train_sampler.load_state_dict({
+                'seed': self.train_sampler.seed,
+                'epoch': self.current_epoch,
+                'start': self.current_step * self.gradient_accumulation_steps * self.train_dataloader.batch_size
+            })
+        self.sampler_position = self.train_sampler.start
         if self.task == 'identification_classification':
             self.converter = identification_classification_converter
         else:
@@ -349,12 +741,17 @@ class Trainer(object):
         torch.cuda.empty_cache()
         self.optimizer.load_state_dict(torch.load(os.path.join(checkpoint_dir, "optimizer.pt")))
         self.scheduler.load_state_dict(torch.load(os.path.join(checkpoint_dir, "scheduler.pt")))
+        if self.grad_scaler is not None and os.path.exists(os.path.join(checkpoint_dir, "scaler.pt")):
+            self.grad_scaler.load_state_dict(torch.load(os.path.join(checkpoint_dir, "scaler.pt")))
 
         model_cls = type(self.model.module if hasattr(self.model, "module") else self.model)
         self.model.to('cpu')
         del self.model
         torch.cuda.empty_cache()
         self.model = model_cls.from_pretrained(checkpoint_dir)
+        if self.frozen_layers > 0:
+            self.model.freeze_bottom_layers(
+                self.frozen_layers, trainable_token_ids=self.trainable_token_ids)
 
         self.deployed = False
 
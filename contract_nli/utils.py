@@ -16,12 +16,16 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
 import random
 import contextlib
+from typing import List, Optional
 
 import numpy as np
 import torch
 
+AUTOCAST_DTYPES = {'bfloat16', 'float16'}
+
 
 def set_seed(seed):
     random.seed(seed)
@@ -37,3 +41,68 @@ def distributed_barrier(blocked: bool, enable: bool = True):
     yield
     if enable and not blocked:
         torch.distributed.barrier()
+
+
+def check_autocast(device: torch.device, dtype: Optional[str]):
+    """
+    Raises ValueError if autocast with dtype is not supported on device by
+    the installed torch. torch<1.10 (e.g. the pinned torch 1.7.1) only
+    supports float16 on CUDA.
+    """
+    if dtype is None:
+        return
+    if dtype not in AUTOCAST_DTYPES:
+        raise ValueError(f'autocast_dtype must be one of {AUTOCAST_DTYPES}')
+    if dtype == 'float16' and device.type != 'cuda':
+        raise ValueError('float16 autocast requires CUDA. Use bfloat16 on CPUs.')
+    if not hasattr(torch, 'autocast') and dtype != 'float16':
+        raise ValueError(
+            f'autocast_dtype {dtype} requires torch>=1.10 (installed: {torch.__version__}). '
+            'Use float16 on CUDA or set autocast_dtype to null.')
+
+
+def autocast(device: torch.device, dtype: Optional[str]):
+    """ Native mixed precision context. It is a no-op when dtype is None. """
+    check_autocast(device, dtype)
+    if dtype is None:
+        return contextlib.nullcontext()
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type=device.type, dtype=getattr(torch, dtype))
+    # torch<1.10 only has float16 autocast on CUDA
+    return torch.cuda.amp.autocast()
+
+
+def inference_mode():
+    """ torch.inference_mode on torch>=1.9 and torch.no_grad otherwise """
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def available_cpus() -> int:
+    """ Number of CPUs this process may run on """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def pin_cpu_threads(local_rank: int, local_world_size: int) -> List[int]:
+    """
+    Splits CPU cores available to this node evenly across local processes,
+    pins this process to its share and sets the intra-op thread count
+    accordingly, so that processes do not oversubscribe cores.
+    Returns the CPU ids assigned to this process.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count()))
+    per_rank = max(1, len(cpus) // local_world_size)
+    assigned = cpus[local_rank * per_rank:(local_rank + 1) * per_rank]
+    if len(assigned) == 0:
+        # more processes than cores
+        assigned = [cpus[local_rank % len(cpus)]]
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, assigned)
+    torch.set_num_threads(len(assigned))
+    return assigned
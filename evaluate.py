@@ -16,6 +16,7 @@ import logging
 
 import click
 
+from contract_nli.dataset.reader import stream_dataset
 from contract_nli.evaluation import evaluate_all
 
 logger = logging.getLogger(__name__)
@@ -32,8 +33,7 @@ def main(task, dataset_path, prediction_path, output_path):
         datefmt="%m/%d/%Y %H:%M:%S",
         level=logging.INFO,
     )
-    with open(dataset_path) as fin:
-        dataset = json.load(fin)
+    dataset = stream_dataset(dataset_path)
     with open(prediction_path) as fin:
         prediction = json.load(fin)
     metrics = evaluate_all(dataset, prediction,
@@ -1,30 +1,50 @@
 import json
+import tempfile
 from sys import argv
 from random import shuffle
 
+from contract_nli.dataset.reader import is_jsonl, iter_documents, load_labels
+
 
 def main():
     '''Give a list of arguments in command line. 
     Arguments should be paths and names to dataset files to be mixed. 
     The last argument should be the path and name of the new dataset file. 
+    Input and output files may be JSON or JSONL (*.jsonl).
     '''
-    datasets = []
-
-    for arg in argv[1:-1]:
-        with open(arg, 'r') as f:
-            dataset = json.load(f)
-            datasets.append(dataset)
-
-    mixed = {'documents': [], 'labels': {}}
-
-    for dataset in datasets:
-        mixed['documents'].extend(dataset['documents'])
-        mixed['labels'].update(dataset['labels'])
-
-    shuffle(mixed['documents'])
-
-    with open(argv[-1], 'w') as outf:
-        json.dump(mixed, outf)
+    labels = {}
+    # Documents are spooled to a temporary file and only their offsets are
+    # shuffled, so that memory is bounded by the largest document
+    offsets = []
+    with tempfile.TemporaryFile(mode='w+b') as spool:
+        for arg in argv[1:-1]:
+            labels.update(load_labels(arg))
+            for document in iter_documents(arg):
+                offsets.append(spool.tell())
+                spool.write(json.dumps(document).encode('utf-8') + b'\n')
+
+        shuffle(offsets)
+
+        def shuffled_documents():
+            for offset in offsets:
+                spool.seek(offset)
+                yield spool.readline().rstrip(b'\n').decode('utf-8')
+
+        with open(argv[-1], 'w') as outf:
+            if is_jsonl(argv[-1]):
+                outf.write(json.dumps({'labels': labels}) + '\n')
+                for document in shuffled_documents():
+                    outf.write(document + '\n')
+            else:
+                # Same as json.dump({'documents': [...], 'labels': labels})
+                outf.write('{"documents": [')
+                for i, document in enumerate(shuffled_documents()):
+                    if i > 0:
+                        outf.write(', ')
+                    outf.write(document)
+                outf.write('], "labels": ')
+                outf.write(json.dumps(labels))
+                outf.write('}')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
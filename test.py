@@ -20,30 +20,39 @@ import torch
 import transformers
 from transformers import AutoConfig, AutoTokenizer
 
+from contract_nli.cascade import NotMentionedGate
 from contract_nli.conf import load_conf
 from contract_nli.dataset.dataset import load_and_cache_examples, \
     load_and_cache_features
 from contract_nli.dataset.encoder import SPAN_TOKEN
+from contract_nli.dataset.reader import stream_dataset
 from contract_nli.evaluation import evaluate_all
 from contract_nli.model.classification import BertForClassification
 from contract_nli.model.identification_classification import \
     MODEL_TYPE_TO_CLASS
 from contract_nli.postprocess import format_json, compute_prob_calibration_coeff
 from contract_nli.predictor import predict, predict_classification
+from contract_nli.utils import check_autocast
 
 logger = logging.getLogger(__name__)
 
 @click.command()
 @click.option('--dev-dataset-path', type=click.Path(exists=True), default=None)
 @click.option('--weights', type=str, help='a Huggingface path to model weights', default=None)
+@click.option(
+    '--segmentation', type=click.Choice(['greedy', 'optimal']), default=None,
+    help='Override the segmentation in conf.yml (e.g. to compare window planners)')
 @click.argument('model-dir', type=click.Path(exists=True))
 @click.argument('dataset-path', type=click.Path(exists=True))
 @click.argument('output-prefix', type=str)
-def main(dev_dataset_path, weights, model_dir, dataset_path, output_prefix):
+def main(dev_dataset_path, weights, segmentation, model_dir, dataset_path, output_prefix):
     conf: dict = load_conf(os.path.join(model_dir, 'conf.yml'))
+    if segmentation is not None:
+        conf['segmentation'] = segmentation
 
     device = torch.device("cuda" if torch.cuda.is_available() and not conf['no_cuda'] else "cpu")
     n_gpu = 0 if conf['no_cuda'] else torch.cuda.device_count()
+    check_autocast(device, conf.get('autocast_dtype'))
 
     # Setup logging
     logging.basicConfig(
@@ -110,6 +119,16 @@ def main(dev_dataset_path, weights, model_dir, dataset_path, output_prefix):
 
     model.to(device)
 
+    not_mentioned_gate = None
+    if conf['task'] == 'identification_classification' and conf.get('cascade_threshold') is not None:
+        gate_path = os.path.join(model_dir, 'not_mentioned_gate.pkl')
+        if os.path.exists(gate_path):
+            not_mentioned_gate = NotMentionedGate.load(gate_path)
+        else:
+            logger.warning(
+                f'cascade_threshold is set but {gate_path} was not found. '
+                'Running the full model on all pairs.')
+
     if dev_dataset_path is not None:
         if conf['task'] != 'identification_classification':
             raise click.BadOptionUsage(
@@ -118,7 +137,7 @@ def main(dev_dataset_path, weights, model_dir, dataset_path, output_prefix):
         examples = load_and_cache_examples(
             dev_dataset_path,
             local_rank=-1,
-            overwrite_cache=True,
+            overwrite_cache=conf.get('overwrite_cache', False),
             cache_dir='.'
         )
         dataset, features = load_and_cache_features(
@@ -130,18 +149,26 @@ def main(dev_dataset_path, weights, model_dir, dataset_path, output_prefix):
             max_query_length=conf['max_query_length'],
             dataset_type=conf['task'],
             symbol_based_hypothesis=conf['symbol_based_hypothesis'],
-            threads=None,
+            threads=conf.get('preprocessing_workers'),
             local_rank=-1,
-            overwrite_cache=True,
+            overwrite_cache=conf.get('overwrite_cache', False),
             labels_available=True,
-            cache_dir='.'
+            cache_dir='.',
+            segmentation=conf.get('segmentation', 'greedy'),
+            segmentation_min_context=conf.get('segmentation_min_context', 0),
+            cache_max_mb=conf.get('feature_cache_max_mb'),
+            compact_features=conf.get('compact_features', False)
         )
         all_results = predict(
             model, dataset, examples, features,
             per_gpu_batch_size=conf['per_gpu_eval_batch_size'],
             device=device, n_gpu=n_gpu,
             weight_class_probs_by_span_probs=conf[
-                'weight_class_probs_by_span_probs'])
+                'weight_class_probs_by_span_probs'],
+            not_mentioned_gate=not_mentioned_gate,
+            gate_threshold=conf.get('cascade_threshold'),
+            autocast_dtype=conf.get('autocast_dtype'),
+            num_workers=conf.get('dataloader_num_workers', 0))
         calibration_coeff = compute_prob_calibration_coeff(
             examples, all_results)
     else:
@@ -150,7 +177,7 @@ def main(dev_dataset_path, weights, model_dir, dataset_path, output_prefix):
     examples = load_and_cache_examples(
         dataset_path,
         local_rank=-1,
-        overwrite_cache=True,
+        overwrite_cache=conf.get('overwrite_cache', False),
         cache_dir='.'
     )
     dataset, features = load_and_cache_features(
@@ -162,11 +189,15 @@ def main(dev_dataset_path, weights, model_dir, dataset_path, output_prefix):
         max_query_length=conf['max_query_length'],
         dataset_type=conf['task'],
         symbol_based_hypothesis=conf['symbol_based_hypothesis'],
-        threads=None,
+        threads=conf.get('preprocessing_workers'),
         local_rank=-1,
-        overwrite_cache=True,
+        overwrite_cache=conf.get('overwrite_cache', False),
         labels_available=True,
-        cache_dir='.'
+        cache_dir='.',
+        segmentation=conf.get('segmentation', 'greedy'),
+        segmentation_min_context=conf.get('segmentation_min_context', 0),
+        cache_max_mb=conf.get('feature_cache_max_mb'),
+        compact_features=conf.get('compact_features', False)
     )
 
     logger.info("***** Start prediction *****")
@@ -177,19 +208,23 @@ def main(dev_dataset_path, weights, model_dir, dataset_path, output_prefix):
             per_gpu_batch_size=conf['per_gpu_eval_batch_size'],
             device=device, n_gpu=n_gpu,
             weight_class_probs_by_span_probs=conf['weight_class_probs_by_span_probs'],
-            calibration_coeff=calibration_coeff)
+            calibration_coeff=calibration_coeff,
+            not_mentioned_gate=not_mentioned_gate,
+            gate_threshold=conf.get('cascade_threshold'),
+            autocast_dtype=conf.get('autocast_dtype'),
+            num_workers=conf.get('dataloader_num_workers', 0))
     else:
         all_results = predict_classification(
             model, dataset, features,
             per_gpu_batch_size=conf['per_gpu_eval_batch_size'],
-            device=device, n_gpu=n_gpu)
+            device=device, n_gpu=n_gpu,
+            autocast_dtype=conf.get('autocast_dtype'),
+            num_workers=conf.get('dataloader_num_workers', 0))
 
     result_json = format_json(examples, all_results)
     with open(output_prefix + 'result.json', 'w') as fout:
         json.dump(result_json, fout, indent=2)
-    with open(dataset_path) as fin:
-        test_dataset = json.load(fin)
-    metrics = evaluate_all(test_dataset, result_json,
+    metrics = evaluate_all(stream_dataset(dataset_path), result_json,
                            [1, 3, 5, 8, 10, 15, 20, 30, 40, 50],
                            conf['task'])
     logger.info(f"Results@: {json.dumps(metrics, indent=2)}")
@@ -0,0 +1,66 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from contract_nli.batch_converter import unpack_mask
+from contract_nli.dataset.encoder import pack_mask, plan_windows_greedy, \
+    plan_windows_optimal
+
+
+def _random_document(rng: random.Random, max_span_length: int):
+    """ Split positions (the first token of each span) and the number of tokens """
+    split_positions = []
+    n_tokens = 0
+    for _ in range(rng.randint(1, 30)):
+        split_positions.append(n_tokens)
+        n_tokens += rng.randint(1, max_span_length)
+    return split_positions, n_tokens
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_optimal_windows_never_more_than_greedy(seed):
+    rng = random.Random(seed)
+    max_context_length = rng.choice([16, 32, 64])
+    # Some spans do not fit in a window
+    split_positions, n_tokens = _random_document(rng, max_context_length + 8)
+    doc_stride = rng.choice([0, 4, max_context_length // 4])
+    greedy = plan_windows_greedy(split_positions, n_tokens, max_context_length, doc_stride)
+    optimal = plan_windows_optimal(split_positions, n_tokens, max_context_length, 0)
+    assert len(optimal) <= len(greedy)
+
+    # Every span that fits in a window is fully contained in one
+    span_ends = split_positions[1:] + [n_tokens]
+    for start, end in zip(split_positions, span_ends):
+        if end - start <= max_context_length:
+            assert any(w <= start and end <= w + max_context_length for w in optimal)
+
+
+@pytest.mark.parametrize('length', [1, 7, 8, 9, 64, 65])
+def test_pack_mask_round_trip(length):
+    mask = np.random.RandomState(length).randint(0, 2, size=(3, length)).astype(np.int8)
+    packed = pack_mask(mask)
+    assert packed.dtype == np.uint8
+    assert packed.shape == (3, (length + 7) // 8)
+    unpacked = unpack_mask(torch.from_numpy(packed), length)
+    assert torch.equal(unpacked.to(torch.int8), torch.from_numpy(mask))
+
+
+def test_unpacked_mask_is_returned_as_is():
+    mask = torch.tensor([[0, 1, 1]], dtype=torch.int8)
+    assert unpack_mask(mask, 3) is mask
@@ -0,0 +1,67 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from types import SimpleNamespace
+
+import torch
+from transformers import BertConfig
+
+from contract_nli.dataset.loader import NLILabel
+from contract_nli.model.identification_classification import \
+    BertForIdentificationClassification, update_config
+from contract_nli.predictor import to_partial_results
+
+
+def _model():
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=50, hidden_size=16, num_hidden_layers=1,
+        num_attention_heads=2, intermediate_size=32, max_position_embeddings=32)
+    return BertForIdentificationClassification(update_config(
+        config, impossible_strategy='ignore', class_loss_weight=1.0))
+
+
+def _none_batch(batch_size=3, seq_len=8):
+    """ Labels of windows without any evidence span (e.g. CUAD-style data) """
+    span_labels = torch.zeros(batch_size, seq_len, dtype=torch.long)
+    span_labels[:, 0] = -1
+    return dict(
+        input_ids=torch.randint(1, 50, (batch_size, seq_len)),
+        attention_mask=torch.ones(batch_size, seq_len, dtype=torch.long),
+        token_type_ids=torch.zeros(batch_size, seq_len, dtype=torch.long),
+        p_mask=torch.zeros(batch_size, seq_len),
+        valid_span_missing_in_context=torch.zeros(batch_size),
+        class_labels=torch.full((batch_size,), NLILabel.NONE.value, dtype=torch.long),
+        span_labels=span_labels)
+
+
+def test_partial_results_of_all_none_batch():
+    model = _model()
+    model.eval()
+    with torch.no_grad():
+        outputs = model(**_none_batch())
+    assert outputs.loss is None
+    features = [SimpleNamespace(unique_id=1000000000 + i) for i in range(5)]
+    results = to_partial_results(outputs, [4, 0, 2], features)
+    assert [r.unique_id for r in results] == [1000000004, 1000000000, 1000000002]
+    assert results[0].class_logits.shape == (3,)
+    assert results[0].span_logits.shape == (8, 2)
+
+
+def test_training_skips_heads_without_loss():
+    model = _model()
+    model.train()
+    outputs = model(**_none_batch())
+    assert outputs.class_logits is None
+    assert outputs.span_logits is None
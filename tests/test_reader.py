@@ -0,0 +1,81 @@
+# Copyright (c) 2021, Hitachi America Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import pytest
+
+from contract_nli.dataset.reader import iter_documents, load_labels, stream_dataset
+
+
+def _dataset():
+    # Strings with quotes, backslashes and brackets must not confuse the
+    # reader when it skips values without decoding them
+    documents = [
+        {
+            'id': i,
+            'text': f'Party "A\\" {{shall}} [not] disclose \\\\ é {i}',
+            'spans': [[0, 5], [6, 10]],
+            'annotation_sets': [{'annotations': {
+                'nda-1': {'choice': 'Entailment', 'spans': [1]}}}],
+            'labels': f'not the labels of the dataset {i}',
+        }
+        for i in range(5)]
+    labels = {'nda-1': {'hypothesis': 'Some "quoted" hypothesis with ] and }'}}
+    return documents, labels
+
+
+@pytest.mark.parametrize('labels_first', [True, False])
+def test_json_parity(tmp_path, labels_first):
+    documents, labels = _dataset()
+    data = {'labels': labels, 'documents': documents} if labels_first \
+        else {'documents': documents, 'labels': labels}
+    path = str(tmp_path / 'dataset.json')
+    with open(path, 'w') as fout:
+        json.dump(data, fout, indent=2 if labels_first else None)
+    with open(path) as fin:
+        expected = json.load(fin)
+
+    assert load_labels(path) == expected['labels']
+    assert list(iter_documents(path)) == expected['documents']
+    dataset = stream_dataset(path)
+    assert dataset['labels'] == expected['labels']
+    assert list(dataset['documents']) == expected['documents']
+
+
+def test_jsonl_parity(tmp_path):
+    documents, labels = _dataset()
+    path = str(tmp_path / 'dataset.jsonl')
+    with open(path, 'w') as fout:
+        for document in documents[:2]:
+            fout.write(json.dumps(document) + '\n')
+        # The labels-only line may have arbitrary whitespace
+        fout.write('  { "labels" :' + json.dumps(labels) + '}\n')
+        fout.write('\n')
+        for document in documents[2:]:
+            fout.write(json.dumps(document) + '\n')
+    with open(path) as fin:
+        lines = [json.loads(line) for line in fin if line.strip() != '']
+
+    assert load_labels(path) == lines[2]['labels']
+    assert list(iter_documents(path)) == lines[:2] + lines[3:]
+
+
+def test_missing_labels(tmp_path):
+    documents, _ = _dataset()
+    path = str(tmp_path / 'dataset.json')
+    with open(path, 'w') as fout:
+        json.dump({'documents': documents}, fout)
+    with pytest.raises(ValueError):
+        load_labels(path)
@@ -26,9 +26,12 @@ import transformers
 from transformers import AutoConfig, AutoTokenizer
 from transformers.trainer_utils import is_main_process
 
+from contract_nli.cascade import NotMentionedGate
 from contract_nli.conf import load_conf
-from contract_nli.dataset.dataset import load_and_cache_examples, load_and_cache_features
+from contract_nli.dataset.dataset import load_and_cache_examples, load_and_cache_features, \
+    load_and_cache_features_sharded, feature_cache_keys, evict_feature_cache
 from contract_nli.dataset.encoder import SPAN_TOKEN
+from contract_nli.dataset.reader import stream_dataset
 from contract_nli.evaluation import evaluate_all
 from contract_nli.model.identification_classification import \
     MODEL_TYPE_TO_CLASS, update_config
@@ -36,7 +39,8 @@ from contract_nli.model.classification import BertForClassification
 from contract_nli.postprocess import format_json
 from contract_nli.predictor import predict, predict_classification
 from contract_nli.trainer import Trainer, setup_optimizer
-from contract_nli.utils import set_seed, distributed_barrier
+from contract_nli.utils import set_seed, distributed_barrier, pin_cpu_threads, check_autocast, \
+    available_cpus
 
 logger = logging.getLogger(__name__)
 
@@ -52,14 +56,28 @@ def main(conf, output_dir, local_rank, shared_filesystem):
     conf: dict = load_conf(conf)
 
     # Setup CUDA, GPU & distributed training
-    if local_rank == -1 or conf['no_cuda']:
+    distributed_backend = conf.get('distributed_backend')
+    if distributed_backend is None:
+        distributed_backend = 'gloo' if conf['no_cuda'] or not torch.cuda.is_available() else 'nccl'
+    if local_rank == -1:
         device = torch.device("cuda" if torch.cuda.is_available() and not conf['no_cuda'] else "cpu")
         n_gpu = 0 if conf['no_cuda'] else torch.cuda.device_count()
+    elif conf['no_cuda'] or not torch.cuda.is_available():
+        # Data-parallel training over CPU processes
+        if distributed_backend != 'gloo':
+            raise ValueError('Distributed training on CPUs requires the gloo backend')
+        device = torch.device("cpu")
+        torch.distributed.init_process_group(backend=distributed_backend)
+        n_gpu = 0
+        pin_cpu_threads(local_rank, int(os.environ.get(
+            'LOCAL_WORLD_SIZE', torch.distributed.get_world_size())))
     else:  # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.cuda.set_device(local_rank)
         device = torch.device("cuda", local_rank)
-        torch.distributed.init_process_group(backend="nccl")
+        torch.distributed.init_process_group(backend=distributed_backend)
         n_gpu = 1
+    # Fails before loading data if the installed torch cannot run autocast_dtype
+    check_autocast(device, conf.get('autocast_dtype'))
 
     # if this is a main process in a node
     local_main = is_main_process(local_rank)
@@ -119,6 +137,10 @@ def main(conf, output_dir, local_rank, shared_filesystem):
                 cache_dir=conf['cache_dir']
             )
 
+    if conf.get('gradient_checkpointing', False):
+        # Recompute activations in the backward pass to trade compute for memory
+        model.gradient_checkpointing_enable()
+
     logger.info("Training/evaluation parameters %s",
                 {k: v for k, v in conf.items() if k != 'raw_yaml'})
 
@@ -132,6 +154,31 @@ def main(conf, output_dir, local_rank, shared_filesystem):
         except ImportError:
             raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
 
+    preprocessing_workers = conf.get('preprocessing_workers')
+    if preprocessing_workers is None and local_rank != -1 and device.type != 'cpu':
+        # Local processes split the CPUs of the node. CPU processes have
+        # already been pinned to their share (see pin_cpu_threads).
+        preprocessing_workers = max(1, available_cpus() // int(os.environ.get(
+            'LOCAL_WORLD_SIZE', torch.distributed.get_world_size())))
+    feature_kwargs = dict(
+        max_seq_length=conf['max_seq_length'],
+        doc_stride=conf.get('doc_stride', None),
+        max_query_length=conf['max_query_length'],
+        dataset_type=conf['task'],
+        symbol_based_hypothesis=conf['symbol_based_hypothesis'],
+        threads=preprocessing_workers,
+        overwrite_cache=conf['overwrite_cache'],
+        labels_available=True,
+        cache_dir='.',
+        segmentation=conf.get('segmentation', 'greedy'),
+        segmentation_min_context=conf.get('segmentation_min_context', 0),
+        cache_max_mb=conf.get('feature_cache_max_mb'),
+        compact_features=conf.get('compact_features', False),
+        # Evicted below once the training and dev sets have been loaded
+        evict=False
+    )
+    # Splits feature construction by documents across distributed processes
+    sharded_features = conf.get('sharded_features', False) and local_rank != -1
     with distributed_barrier(not fs_main, local_rank != -1):
         examples = load_and_cache_examples(
             conf['train_file'],
@@ -170,23 +217,23 @@ def main(conf, output_dir, local_rank, shared_filesystem):
                     f'Hypothesis symbols were added as "{hypothesis_symbol_dic}". '
                     'You can safely ignore this warning if you are training a '
                     'model from pretrained LMs.')
+        # Embeddings of added tokens are randomly initialized and are trained
+        # even when the embeddings are frozen
+        n_embeddings = model.get_input_embeddings().num_embeddings
+        trainable_token_ids = list(range(n_embeddings, len(tokenizer)))
         model.resize_token_embeddings(len(tokenizer))
 
-        train_dataset = load_and_cache_features(
-            conf['train_file'],
-            examples,
-            tokenizer,
-            max_seq_length=conf['max_seq_length'],
-            doc_stride=conf.get('doc_stride', None),
-            max_query_length=conf['max_query_length'],
-            dataset_type=conf['task'],
-            symbol_based_hypothesis=conf['symbol_based_hypothesis'],
-            threads=None,
-            local_rank=local_rank,
-            overwrite_cache=conf['overwrite_cache'],
-            labels_available=True,
-            cache_dir='.',
-        )[0]
+        if not sharded_features:
+            train_dataset = load_and_cache_features(
+                conf['train_file'], examples, tokenizer, local_rank=local_rank,
+                **feature_kwargs)[0]
+    if sharded_features:
+        # Every process builds features of its own documents only
+        train_dataset = load_and_cache_features_sharded(
+            conf['train_file'], examples, tokenizer,
+            rank=torch.distributed.get_rank(),
+            world_size=torch.distributed.get_world_size(),
+            **feature_kwargs)[0]
 
     if conf['dev_file'] is not None:
         with distributed_barrier(not fs_main, local_rank != -1):
@@ -196,25 +243,35 @@ def main(conf, output_dir, local_rank, shared_filesystem):
                 overwrite_cache=conf['overwrite_cache'],
                 cache_dir='.'
             )
-            dev_dataset, dev_features = load_and_cache_features(
-                conf['dev_file'],
-                dev_examples,
-                tokenizer,
-                max_seq_length=conf['max_seq_length'],
-                doc_stride=conf.get('doc_stride', None),
-                max_query_length=conf['max_query_length'],
-                dataset_type=conf['task'],
-                symbol_based_hypothesis=conf['symbol_based_hypothesis'],
-                threads=None,
-                local_rank=local_rank,
-                overwrite_cache=conf['overwrite_cache'],
-                labels_available=True,
-                cache_dir='.'
-            )
+            if not (sharded_features and shared_filesystem):
+                dev_dataset, dev_features = load_and_cache_features(
+                    conf['dev_file'], dev_examples, tokenizer,
+                    local_rank=local_rank, **feature_kwargs)
+        if sharded_features and shared_filesystem:
+            # All processes validate on all features, so shards are merged
+            # through the shared filesystem
+            dev_dataset, dev_features = load_and_cache_features_sharded(
+                conf['dev_file'], dev_examples, tokenizer,
+                rank=torch.distributed.get_rank(),
+                world_size=torch.distributed.get_world_size(),
+                merge=True, **feature_kwargs)
 
     else:
         dev_dataset, dev_examples, dev_features = None, None, None
 
+    if conf.get('feature_cache_max_mb') is not None:
+        # Waits for every process to load its features, which may be read
+        # from the cache until then
+        if local_rank != -1:
+            torch.distributed.barrier()
+        if fs_main:
+            keep = feature_cache_keys(examples, tokenizer, **feature_kwargs)
+            if dev_examples is not None:
+                keep += feature_cache_keys(dev_examples, tokenizer, **feature_kwargs)
+            evict_feature_cache(
+                keep, cache_dir=feature_kwargs['cache_dir'],
+                cache_max_mb=feature_kwargs['cache_max_mb'])
+
     optimizer = setup_optimizer(
         model, learning_rate=conf['learning_rate'], epsilon=conf['adam_epsilon'],
         weight_decay=conf['weight_decay'])
@@ -229,7 +286,7 @@ def main(conf, output_dir, local_rank, shared_filesystem):
         max_steps=conf['max_steps'],
         dev_dataset=dev_dataset,
         valid_steps=conf['valid_steps'],
-        per_gpu_dev_batch_size=conf['per_gpu_eval_batch_size'],
+        per_gpu_dev_batch_size=conf.get('per_gpu_valid_batch_size', conf['per_gpu_eval_batch_size']),
         gradient_accumulation_steps=conf['gradient_accumulation_steps'],
         warmup_steps=conf['warmup_steps'],
         max_grad_norm=conf['max_grad_norm'],
@@ -238,9 +295,31 @@ def main(conf, output_dir, local_rank, shared_filesystem):
         fp16=conf['fp16'],
         fp16_opt_level=conf['fp16_opt_level'],
         device=device,
-        save_steps=conf['save_steps'])
+        save_steps=conf['save_steps'],
+        frozen_layers=conf.get('frozen_layers', 0),
+        activation_cache=conf.get('activation_cache', False),
+        trainable_token_ids=trainable_token_ids,
+        autocast_dtype=conf.get('autocast_dtype'),
+        seed=conf['seed'],
+        num_workers=conf.get('dataloader_num_workers', 0),
+        logging_steps=conf.get('logging_steps', 1),
+        span_map_steps=conf.get('span_map_steps', 1),
+        span_map_samples=conf.get('span_map_samples'),
+        dev_subsample=conf.get('dev_subsample'),
+        dev_examples=dev_examples,
+        dev_features=dev_features,
+        validation_metric=conf.get('validation_metric'),
+        weight_class_probs_by_span_probs=conf['weight_class_probs_by_span_probs'],
+        early_stopping_patience=conf.get('early_stopping_patience'),
+        early_stopping_min_delta=conf.get('early_stopping_min_delta', 0.0),
+        save_total_limit=conf.get('save_total_limit'),
+        timer_cuda_sync=conf.get('timer_cuda_sync', False),
+        profile_steps=conf.get('profile_steps'),
+        find_unused_parameters=conf.get('find_unused_parameters'),
+        train_dataset_sharded=sharded_features)
     trainer.deploy()
     trainer.train()
+    trainer.close()
 
     # FIXME: Prediction using multiple GPUs
     if not all_main:
@@ -266,6 +345,12 @@ def main(conf, output_dir, local_rank, shared_filesystem):
         trainer.deploy()
         model = trainer.model
 
+    not_mentioned_gate = None
+    if conf['task'] == 'identification_classification' and conf.get('cascade_threshold') is not None:
+        logger.info("Training NotMentioned gate for cascaded inference")
+        not_mentioned_gate = NotMentionedGate().fit(examples)
+        not_mentioned_gate.save(os.path.join(output_dir, 'not_mentioned_gate.pkl'))
+
     if dev_dataset is not None:
         logger.info("Evaluate the on validation data")
         if conf['task'] == 'identification_classification':
@@ -273,18 +358,22 @@ def main(conf, output_dir, local_rank, shared_filesystem):
                 model, dev_dataset, dev_examples, dev_features,
                 per_gpu_batch_size=conf['per_gpu_eval_batch_size'],
                 device=device, n_gpu=n_gpu,
-                weight_class_probs_by_span_probs=conf['weight_class_probs_by_span_probs'])
+                weight_class_probs_by_span_probs=conf['weight_class_probs_by_span_probs'],
+                not_mentioned_gate=not_mentioned_gate,
+                gate_threshold=conf.get('cascade_threshold'),
+                autocast_dtype=conf.get('autocast_dtype'),
+                num_workers=conf.get('dataloader_num_workers', 0))
         else:
             all_results = predict_classification(
                 model, dev_dataset, dev_features,
                 per_gpu_batch_size=conf['per_gpu_eval_batch_size'],
-                device=device, n_gpu=n_gpu)
+                device=device, n_gpu=n_gpu,
+                autocast_dtype=conf.get('autocast_dtype'),
+                num_workers=conf.get('dataloader_num_workers', 0))
         result_json = format_json(dev_examples, all_results)
         with open(os.path.join(output_dir, f'result.json'), 'w') as fout:
             json.dump(result_json, fout, indent=2)
-        with open(conf['dev_file']) as fin:
-            dev_json = json.load(fin)
-        metrics = evaluate_all(dev_json, result_json,
+        metrics = evaluate_all(stream_dataset(conf['dev_file']), result_json,
                                [1, 3, 5, 8, 10, 15, 20, 30, 40, 50],
                                conf['task'])
         logger.info(f"Results@: {json.dumps(metrics, indent=2)}")